@@ -0,0 +1,124 @@
+"""Look up an API by name in an account with thousands of APIs, against a
+stand-in for API Gateway that waits `--latency` milliseconds per call.
+
+The old lookup scanned the items of a single `get_rest_apis` call, so it
+missed every API past the first page. It is timed here paging through
+every API with API Gateway's default page size of 25, which is the least
+it would have taken to be correct.
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from common import best_of, report
+
+from yoke.deploy import Deployment
+
+DEFAULT_PAGE_SIZE = 25
+
+
+class Paginator(object):
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+
+    def paginate(self, PaginationConfig=None):
+        size = (PaginationConfig or {}).get('PageSize', DEFAULT_PAGE_SIZE)
+        for start in range(0, len(self.gateway.items), size):
+            yield self.gateway.get_rest_apis(position=start, limit=size)
+
+
+class ApiGatewayStandIn(object):
+
+    def __init__(self, apis, latency):
+        self.items = [{'id': 'id{}'.format(index),
+                       'name': 'api-{}'.format(index)}
+                      for index in range(apis)]
+        self.by_id = dict((item['id'], item) for item in self.items)
+        self.latency = latency
+        self.calls = 0
+
+    def call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def get_paginator(self, operation):
+        assert operation == 'get_rest_apis'
+        return Paginator(self)
+
+    def get_rest_apis(self, position=0, limit=DEFAULT_PAGE_SIZE):
+        self.call()
+        return {'items': self.items[position:position + limit]}
+
+    def get_rest_api(self, restApiId):
+        self.call()
+        return self.by_id[restApiId]
+
+
+def linear_scan(client, name):
+    for page in client.get_paginator('get_rest_apis').paginate():
+        for item in page['items']:
+            if item['name'] == name:
+                return item
+    return None
+
+
+def deployment(project_dir, name):
+    deploy = Deployment.__new__(Deployment)
+    deploy.config = {'apiGateway': {'name': name}}
+    deploy.project_dir = project_dir
+    deploy.account_id = '123456789012'
+    deploy.region = 'us-east-1'
+    return deploy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--apis', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=5,
+                        help='milliseconds per API Gateway call')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    client = ApiGatewayStandIn(args.apis, args.latency / 1000.0)
+    # The worst case for a scan: the API is on the last page.
+    name = client.items[-1]['name']
+    project_dir = tempfile.mkdtemp(prefix='yoke-bench-')
+    os.environ.pop('YOKE_CACHE_DIR', None)
+    os.environ.pop('YOKE_NO_CACHE', None)
+    try:
+        deploy = deployment(project_dir, name)
+        if (linear_scan(client, name) != client.items[-1] or
+                deploy.find_api(client) != client.items[-1] or
+                deploy.find_api(client) != client.items[-1]):
+            raise SystemExit('The lookups disagree.')
+
+        def cold():
+            shutil.rmtree(os.path.join(project_dir, '.yoke'),
+                          ignore_errors=True)
+            deploy.find_api(client)
+
+        print('{} APIs, {}ms per call'.format(args.apis, args.latency))
+        baseline = None
+        for label, func in (
+                ('linear scan', lambda: linear_scan(client, name)),
+                ('find_api, cold cache', cold),
+                ('find_api, cached index',
+                 lambda: deploy.find_api(client))):
+            client.calls = 0
+            func()
+            label = '{} ({} calls)'.format(label, client.calls)
+            seconds = best_of(func, args.repeat)
+            report(label, seconds, baseline)
+            baseline = baseline or seconds
+    finally:
+        shutil.rmtree(project_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Helpers shared by the benchmark scripts.
+
+The scripts run from a checkout, e.g. `python benchmarks/config_render.py`,
+with yoke's requirements installed.
+"""
+
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def best_of(func, repeat):
+    """Seconds taken by the fastest of `repeat` calls of `func`."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def report(label, seconds, baseline=None):
+    line = '{:<44} {:>10.1f}ms'.format(label, seconds * 1000)
+    if baseline:
+        line += '  {:>6.1f}x'.format(baseline / seconds)
+    print(line)
@@ -0,0 +1,82 @@
+"""Template and load a large synthetic yoke.yml, with the streaming
+`RenderedConfig` and with the line by line `render_config` it replaced."""
+
+import argparse
+import re
+
+from common import best_of, report
+
+import ruamel.yaml as yaml
+
+from yoke import utils
+from yoke.config import RenderedConfig
+
+
+def old_render_config(config, env_dict):
+    # `YokeConfig.render_config` before the streaming renderer.
+    rendered = []
+    p = re.compile(r".*?\{\{ (.*?) \}\}.*?")
+    for line in config:
+        match = p.findall(line)
+        for var in match:
+            replace_var = env_dict[var]
+            line = line.replace("{{{{ {} }}}}".format(var), replace_var, 1)
+        rendered.append(line)
+    return ''.join(rendered)
+
+
+def synthetic_config(stages, keys, variables):
+    lines = ['stages:\n']
+    for stage in range(stages):
+        lines.append('  stage{}:\n'.format(stage))
+        lines.append('    config:\n')
+        for key in range(keys):
+            lines.append('      KEY_{}: "{{{{ VAR_{} }}}}-{{{{ VAR_{} }}}}"\n'
+                         .format(key, (stage + key) % variables,
+                                 key % variables))
+    env = dict(('VAR_{}'.format(var), 'value-{}'.format(var))
+               for var in range(variables))
+    return lines, env
+
+
+def new_render(lines, env):
+    stream = RenderedConfig(lines, env)
+    rendered = stream.read()
+    stream.check()
+    return rendered
+
+
+def new_load(lines, env):
+    stream = RenderedConfig(lines, env)
+    config = utils.load_yaml(stream)
+    stream.check()
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stages', type=int, default=50)
+    parser.add_argument('--keys', type=int, default=400)
+    parser.add_argument('--variables', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines, env = synthetic_config(args.stages, args.keys, args.variables)
+    print('{} lines, {} placeholders'.format(
+        len(lines), sum(line.count('{{') for line in lines)))
+    if new_render(lines, env) != old_render_config(lines, env):
+        raise SystemExit('The renderers disagree.')
+
+    old = best_of(lambda: old_render_config(lines, env), args.repeat)
+    report('render_config', old)
+    report('RenderedConfig', best_of(lambda: new_render(lines, env),
+                                     args.repeat), old)
+    old = best_of(lambda: yaml.safe_load(old_render_config(lines, env)),
+                  args.repeat)
+    report('render_config + yaml.safe_load', old)
+    report('RenderedConfig streamed into load_yaml',
+           best_of(lambda: new_load(lines, env), args.repeat), old)
+
+
+if __name__ == '__main__':
+    main()
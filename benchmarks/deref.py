@@ -0,0 +1,129 @@
+"""Dereference a synthetic Swagger document with thousands of `$ref`s, with
+`yoke.refs` and with the jsonref + deepcopy it replaced."""
+
+import argparse
+import copy
+import json
+import tracemalloc
+
+from common import best_of, report
+
+import jsonref
+
+from yoke import refs
+
+# Models without references, everything else refers to them or to models
+# referring to them.
+LEAF_MODELS = 10
+
+
+def old_deref(document):
+    # `Deployment.deref` before `yoke.refs`.
+    return copy.deepcopy(jsonref.JsonRef.replace_refs(document))
+
+
+def synthetic_spec(paths, definitions):
+    """Definitions referring to each other, used by every operation's
+    parameters and responses."""
+    spec = {
+        'swagger': '2.0',
+        'info': {'title': 'benchmark', 'version': '1'},
+        'parameters': {
+            'Limit': {'name': 'limit', 'in': 'query', 'type': 'integer'},
+        },
+        'definitions': {},
+        'paths': {},
+    }
+    for index in range(definitions):
+        properties = {
+            'id': {'type': 'string'},
+            'name': {'type': 'string', 'description': 'x' * 40},
+        }
+        if index >= LEAF_MODELS:
+            properties['owner'] = {
+                '$ref': '#/definitions/Model{}'.format(index % LEAF_MODELS)}
+            properties['children'] = {
+                'type': 'array',
+                'items': {'$ref': '#/definitions/Model{}'.format(
+                    index // LEAF_MODELS)}}
+        spec['definitions']['Model{}'.format(index)] = {
+            'type': 'object', 'properties': properties}
+    for index in range(paths):
+        model = '#/definitions/Model{}'.format(index % definitions)
+        spec['paths']['/resource{}'.format(index)] = {
+            'get': {
+                'parameters': [{'$ref': '#/parameters/Limit'}],
+                'responses': {
+                    '200': {'description': 'ok', 'schema': {'$ref': model}},
+                },
+            },
+            'post': {
+                'parameters': [{'name': 'body', 'in': 'body',
+                                'schema': {'$ref': model}}],
+                'responses': {
+                    '201': {'description': 'created',
+                            'schema': {'$ref': model}},
+                },
+            },
+        }
+    return spec
+
+
+def count_refs(node):
+    if isinstance(node, dict):
+        return int('$ref' in node) + sum(count_refs(value)
+                                         for value in node.values())
+    if isinstance(node, list):
+        return sum(count_refs(item) for item in node)
+    return 0
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--paths', type=int, default=1500)
+    parser.add_argument('--definitions', type=int, default=100)
+    parser.add_argument('--spec', metavar='FILE',
+                        help='a Swagger JSON file to use instead of a '
+                             'synthetic one, e.g. a rendered swagger.json')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.spec:
+        with open(args.spec, 'r') as fh:
+            spec = json.load(fh)
+    else:
+        spec = synthetic_spec(args.paths, args.definitions)
+    print('{} $refs'.format(count_refs(spec)))
+    old_json = json.dumps(old_deref(spec), sort_keys=True)
+    new_json = json.dumps(refs.deref(spec), sort_keys=True)
+    if old_json != new_json:
+        raise SystemExit('The dereferenced documents differ.')
+    print('Same output, {:.1f}MB of JSON'.format(
+        len(new_json) / (1024.0 * 1024)))
+
+    old = best_of(lambda: old_deref(spec), args.repeat)
+    report('jsonref + deepcopy', old)
+    report('yoke.refs', best_of(lambda: refs.deref(spec), args.repeat), old)
+    # Serializing is where jsonref's proxies used to be resolved again.
+    old = best_of(lambda: json.dumps(old_deref(spec)), args.repeat)
+    report('jsonref + deepcopy + json.dumps', old)
+    report('yoke.refs + json.dumps',
+           best_of(lambda: json.dumps(refs.deref(spec)), args.repeat), old)
+
+    old = peak_memory(lambda: json.dumps(old_deref(spec)))
+    new = peak_memory(lambda: json.dumps(refs.deref(spec)))
+    print('Peak memory: {:.1f}MB with jsonref, {:.1f}MB with yoke.refs'.format(
+        old / (1024.0 * 1024), new / (1024.0 * 1024)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Build a Lambda package from a large synthetic source tree with an
+increasing number of compression workers."""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+
+from common import best_of, report
+
+from yoke import packager
+
+
+def synthetic_tree(root, files, size):
+    rand = random.Random(0)
+    words = [''.join(rand.choice('abcdefghijklmnopqrstuvwxyz')
+                     for _ in range(rand.randint(2, 10)))
+             for _ in range(2000)]
+    for index in range(files):
+        directory = os.path.join(root, 'package{}'.format(index % 50))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if index % 3:
+            # Source code and the like, compresses well.
+            name = 'module{}.py'.format(index)
+            data = ' '.join(rand.choice(words) for _ in range(size // 6))
+            data = data.encode('ascii')[:size]
+        else:
+            # Shared objects, wheels, images: mostly incompressible.
+            name = 'library{}.so'.format(index)
+            data = os.urandom(size)
+        with open(os.path.join(directory, name), 'wb') as fh:
+            fh.write(data)
+
+
+def worker_counts(maximum):
+    counts = [1]
+    while counts[-1] * 2 <= maximum:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != maximum:
+        counts.append(maximum)
+    return counts
+
+
+def build(root, zip_file, workers):
+    entries = packager.collect_entries(root)
+    packager.ZipBuilder(zip_file, workers=workers).build(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=600)
+    parser.add_argument('--size', type=int, default=256 * 1024,
+                        help='bytes per file')
+    parser.add_argument('--max-workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    # ZipBuilder logs every package it writes.
+    logging.disable(logging.WARNING)
+
+    work_dir = tempfile.mkdtemp(prefix='yoke-bench-')
+    try:
+        root = os.path.join(work_dir, 'src')
+        synthetic_tree(root, args.files, args.size)
+        print('{} files, {:.0f}MB, {} CPUs'.format(
+            args.files, args.files * args.size / (1024.0 * 1024),
+            multiprocessing.cpu_count()))
+        baseline = None
+        packages = set()
+        for workers in worker_counts(args.max_workers):
+            zip_file = os.path.join(work_dir, '{}.zip'.format(workers))
+            seconds = best_of(lambda: build(root, zip_file, workers),
+                              args.repeat)
+            report('workers={}'.format(workers), seconds, baseline)
+            baseline = baseline or seconds
+            with open(zip_file, 'rb') as fh:
+                packages.add(fh.read())
+        if len(packages) != 1:
+            raise SystemExit('The packages differ between worker counts.')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Check the import time of the modules behind each yoke subcommand against
+a budget, so heavy dependencies don't creep back into CLI startup.
+
+Every module is imported in a fresh interpreter under `-X importtime`
+(Python 3.7 or later), and the fastest of `--runs` imports is compared
+with its budget. Exits with status 1 if any module is over budget.
+"""
+
+import argparse
+from collections import OrderedDict
+import os
+import subprocess
+import sys
+
+from common import ROOT
+
+from yoke.import_profile import parse_importtime
+
+# Milliseconds, generous enough for a slow CI runner.
+BUDGETS = OrderedDict([
+    # Argument parsing and --help, for every subcommand.
+    ('yoke.shell', 100),
+    # encrypt and decrypt.
+    ('yoke.utils', 600),
+    # build, build-dependencies, deploy and profile-imports.
+    ('yoke.deploy', 900),
+])
+
+
+def import_time(module):
+    """Cumulative import time of `module` in a fresh interpreter, in
+    milliseconds."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    _, err = process.communicate()
+    err = err.decode('utf-8', 'replace')
+    if process.returncode != 0:
+        raise SystemExit('Importing {} failed:\n{}'.format(module, err))
+    for root in parse_importtime(err):
+        if root.name == module:
+            return root.cumulative_us / 1000.0
+    raise SystemExit('No import time reported for {}, -X importtime needs '
+                     'Python 3.7 or later.'.format(module))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply every budget by this factor')
+    args = parser.parse_args()
+
+    over = False
+    for module, budget in BUDGETS.items():
+        budget *= args.scale
+        best = min(import_time(module) for _ in range(args.runs))
+        status = 'ok' if best <= budget else 'OVER BUDGET'
+        over = over or best > budget
+        print('{:<20} {:>8.1f}ms  budget {:>6.0f}ms  {}'.format(
+            module, best, budget, status))
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
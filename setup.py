@@ -7,14 +7,17 @@ INSTALL_REQUIRES = [
     'boto3>=1.4.2',
     'botocore>=1.4.85',
     'docker>=2.0.0',
+    'futures>=3.0.5;python_version<"3.0"',
     'Jinja2>=2.8',
     'jsonref>=0.1',
-    'lambda-uploader>=1.2.0',
-    'retrying>=1.3.3',
     'ruamel.yaml>=0.11.11',
     'six>=1.10.0',
 ]
 
+EXTRAS_REQUIRE = {
+    'secret-cache': ['cryptography>=1.9'],
+}
+
 
 def package_meta():
     """Read __init__.py for global package metadata.
@@ -50,6 +53,7 @@ setup(
     packages=find_packages(exclude=['tests', 'examples']),
     test_suite='tests',
     install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
     classifiers=[
         "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3.6",
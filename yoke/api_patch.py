@@ -0,0 +1,195 @@
+"""Translate changes between two Swagger documents into targeted API Gateway
+update calls.
+
+Only changes to the `x-amazon-apigateway-integration` section of existing
+methods are supported - anything else (new paths, methods, models, ...)
+returns `None` and has to go through a full import.
+"""
+
+import logging
+
+from botocore.exceptions import ClientError
+
+LOG = logging.getLogger(__name__)
+
+AWS_INTEGRATION = 'x-amazon-apigateway-integration'
+ANY_METHOD = 'x-amazon-apigateway-any-method'
+HTTP_METHODS = ('get', 'put', 'post', 'delete', 'options', 'head', 'patch')
+
+# Integration fields that can be replaced in place.
+INTEGRATION_FIELDS = ('uri', 'credentials', 'httpMethod',
+                      'passthroughBehavior', 'contentHandling',
+                      'timeoutInMillis')
+INTEGRATION_MAPS = ('requestParameters', 'requestTemplates')
+RESPONSE_FIELDS = ('contentHandling',)
+RESPONSE_MAPS = ('responseParameters', 'responseTemplates')
+
+
+class Patch(object):
+
+    def __init__(self, path, method, ops, status_code=None):
+        self.path = path
+        self.method = method
+        self.ops = ops
+        self.status_code = status_code
+
+
+def escape(key):
+    # Patch operation paths are JSON pointers.
+    return key.replace('~', '~0').replace('/', '~1')
+
+
+def without(data, key):
+    return dict((k, v) for k, v in data.items() if k != key)
+
+
+def diff_fields(old, new, fields):
+    ops = []
+    for field in fields:
+        if old.get(field) == new.get(field):
+            continue
+        if new.get(field) is None:
+            # Removing a field isn't supported for all of them.
+            return None
+        ops.append({'op': 'replace', 'path': '/{}'.format(field),
+                    'value': str(new[field])})
+    return ops
+
+
+def diff_maps(old, new, maps):
+    ops = []
+    for name in maps:
+        old_map = old.get(name) or {}
+        new_map = new.get(name) or {}
+        for key in sorted(set(old_map) | set(new_map)):
+            path = '/{}/{}'.format(name, escape(key))
+            if key not in new_map:
+                ops.append({'op': 'remove', 'path': path})
+            elif key not in old_map:
+                ops.append({'op': 'add', 'path': path,
+                            'value': new_map[key]})
+            elif old_map[key] != new_map[key]:
+                ops.append({'op': 'replace', 'path': path,
+                            'value': new_map[key]})
+    return ops
+
+
+def diff_integration(path, method, old, new):
+    # Anything else, including the integration type, needs a full import.
+    known = set(INTEGRATION_FIELDS + INTEGRATION_MAPS + ('responses',))
+    if any(old.get(key) != new.get(key)
+           for key in set(old) | set(new) if key not in known):
+        return None
+
+    patches = []
+    ops = diff_fields(old, new, INTEGRATION_FIELDS)
+    if ops is None:
+        return None
+    ops.extend(diff_maps(old, new, INTEGRATION_MAPS))
+    if ops:
+        patches.append(Patch(path, method, ops))
+
+    old_responses = old.get('responses') or {}
+    new_responses = new.get('responses') or {}
+    if set(old_responses) != set(new_responses):
+        return None
+    for pattern in sorted(old_responses):
+        old_resp = old_responses[pattern]
+        new_resp = new_responses[pattern]
+        if old_resp == new_resp:
+            continue
+        known = set(RESPONSE_FIELDS + RESPONSE_MAPS + ('statusCode',))
+        if (old_resp.get('statusCode') != new_resp.get('statusCode') or
+                set(old_resp) - known or set(new_resp) - known):
+            return None
+        ops = diff_fields(old_resp, new_resp, RESPONSE_FIELDS)
+        if ops is None:
+            return None
+        ops.extend(diff_maps(old_resp, new_resp, RESPONSE_MAPS))
+        patches.append(Patch(path, method, ops,
+                             status_code=str(new_resp['statusCode'])))
+    return patches
+
+
+def diff(old_body, new_body):
+    """Return the list of `Patch`es turning `old_body` into `new_body`, or
+    `None` if that can't be done with integration updates alone."""
+    if without(old_body, 'paths') != without(new_body, 'paths'):
+        return None
+    old_paths = old_body.get('paths') or {}
+    new_paths = new_body.get('paths') or {}
+    if set(old_paths) != set(new_paths):
+        return None
+
+    patches = []
+    for path in sorted(old_paths):
+        old_item, new_item = old_paths[path], new_paths[path]
+        if set(old_item) != set(new_item):
+            return None
+        for key in sorted(old_item):
+            if key not in HTTP_METHODS and key != ANY_METHOD:
+                if old_item[key] != new_item[key]:
+                    return None
+                continue
+            old_op, new_op = old_item[key], new_item[key]
+            if without(old_op, AWS_INTEGRATION) != without(new_op,
+                                                           AWS_INTEGRATION):
+                return None
+            old_int = old_op.get(AWS_INTEGRATION)
+            new_int = new_op.get(AWS_INTEGRATION)
+            if old_int == new_int:
+                continue
+            if old_int is None or new_int is None:
+                return None
+            method = 'ANY' if key == ANY_METHOD else key.upper()
+            method_patches = diff_integration(path, method, old_int, new_int)
+            if method_patches is None:
+                return None
+            patches.extend(method_patches)
+    return patches
+
+
+def resource_path(body, path):
+    # Matches the `basepath=prepend` import parameter.
+    base_path = (body.get('basePath') or '').rstrip('/')
+    return '{}{}'.format(base_path, path) or '/'
+
+
+def get_resource_ids(client, api_id):
+    paginator = client.get_paginator('get_resources')
+    resource_ids = {}
+    for page in paginator.paginate(restApiId=api_id,
+                                   PaginationConfig={'PageSize': 500}):
+        for item in page.get('items', []):
+            resource_ids[item['path']] = item['id']
+    return resource_ids
+
+
+def apply(client, api_id, body, patches):
+    """Send `patches` to the API. Returns False if the API doesn't match the
+    Swagger they were computed from, and a full import is needed instead."""
+    resource_ids = get_resource_ids(client, api_id)
+    # Check every resource before changing anything.
+    for patch in patches:
+        path = resource_path(body, patch.path)
+        if path not in resource_ids:
+            LOG.warning("Resource %s not found in API %s.", path, api_id)
+            return False
+    for patch in patches:
+        path = resource_path(body, patch.path)
+        kwargs = dict(restApiId=api_id, resourceId=resource_ids[path],
+                      httpMethod=patch.method, patchOperations=patch.ops)
+        try:
+            if patch.status_code is None:
+                LOG.warning("Updating integration for %s %s ...",
+                            patch.method, path)
+                client.update_integration(**kwargs)
+            else:
+                LOG.warning("Updating %s integration response for %s %s ...",
+                            patch.status_code, patch.method, path)
+                client.update_integration_response(
+                    statusCode=patch.status_code, **kwargs)
+        except ClientError as exc:
+            LOG.warning("Updating %s %s failed: %s", patch.method, path, exc)
+            return False
+    return True
@@ -0,0 +1,54 @@
+import logging
+import os
+import threading
+
+import boto3
+
+from .throttle import SCHEDULER
+
+LOG = logging.getLogger(__name__)
+
+# boto3 sessions are not thread-safe, so clients are created under a lock.
+# The clients themselves can be shared between threads.
+_LOCK = threading.RLock()
+_SESSION = None
+_CLIENTS = {}
+_IDENTITY = None
+
+
+def get_session():
+    global _SESSION
+    with _LOCK:
+        if _SESSION is None:
+            _SESSION = boto3.session.Session()
+        return _SESSION
+
+
+def get_client(service, region_name=None):
+    key = (service, region_name)
+    with _LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            LOG.debug("Creating %s client for region %s", service,
+                      region_name)
+            # Allow pointing a service at a local stand-in, e.g.
+            # YOKE_KMS_ENDPOINT_URL=http://localhost:8080
+            endpoint_url = os.environ.get(
+                'YOKE_{}_ENDPOINT_URL'.format(service.upper()))
+            client = get_session().client(service, region_name=region_name,
+                                          endpoint_url=endpoint_url)
+            SCHEDULER.register(client, service)
+            _CLIENTS[key] = client
+        return client
+
+
+def get_caller_identity():
+    global _IDENTITY
+    with _LOCK:
+        if _IDENTITY is None:
+            _IDENTITY = get_client('sts').get_caller_identity()
+        return _IDENTITY
+
+
+def get_account_id():
+    return str(get_caller_identity()['Account'])
@@ -7,8 +7,7 @@ from io import BytesIO
 from tempfile import mkstemp
 import time
 
-import docker
-
+from . import trace
 from .templates import DOCKER_BUILD_SCRIPT
 from .templates import DOCKER_INSTALL_SCRIPT
 
@@ -79,8 +78,15 @@ def remove_container(container):
         )
 
 
+def docker_from_env():
+    # docker (and requests with it) is slow to import, and only dependency
+    # builds need it.
+    import docker
+    return docker.from_env(version='auto')
+
+
 def create_volume_container(image='alpine:3.6', command='/bin/true', **kwargs):
-    docker_client = docker.from_env(version='auto')
+    docker_client = docker_from_env()
     docker_client.images.pull(image)
     container = docker_client.containers.create(
         image,
@@ -91,7 +97,7 @@ def create_volume_container(image='alpine:3.6', command='/bin/true', **kwargs):
 
 
 def create_volume(name):
-    api = docker.from_env(version='auto')
+    api = docker_from_env()
     return api.volumes.create(name)
 
 
@@ -116,7 +122,7 @@ def setup_dependency_volumes(
                     install_script_path=None):
     LOG.warning('Setting up dependency volumes...')
     if docker_client is None:
-        docker_client = docker.from_env(version='auto')
+        docker_client = docker_from_env()
 
     wheelhouse_volume = docker_client.volumes.create()
     project_volume = docker_client.volumes.create()
@@ -143,7 +149,7 @@ def setup_build_volumes(
                     lambda_path=None,
                     install_script_path=None):
     if docker_client is None:
-        docker_client = docker.from_env(version='auto')
+        docker_client = docker_from_env()
 
     wheelhouse_volume = docker_client.volumes.create()
     lambda_volume = docker_client.volumes.create()
@@ -189,6 +195,7 @@ def export_installed_dependencies(container, src_path, dst_path):
     with tarfile.open(fileobj=stream, mode='r') as tar:
         tar.extractall(path=dst_path)
     LOG.warning('%s bytes of dependencies exported', byte_count)
+    trace.annotate(bytes=byte_count)
 
 
 def export_wheelhouse(container, dst_path):
@@ -242,6 +249,22 @@ class PythonDependencyBuilder(object):
         self.build_libffi = build_libffi
         self.build_libxml = build_libxml
 
+    def requirements_sha1(self):
+        requirements_file = os.path.join(self.lambda_path, 'requirements.txt')
+        with open(requirements_file, 'r') as fp:
+            return sha1(fp.read().encode('utf-8')).hexdigest()
+
+    def install_path(self):
+        return os.path.abspath(os.path.join(self.project_path,
+                                            self.install_dir))
+
+    def build_key(self):
+        """Builders with the same key produce the same dependencies in the
+        same place, so only one of them has to run."""
+        return (self.requirements_sha1(), self.runtime,
+                tuple(sorted(self.extra_packages)), self.build_openssl,
+                self.build_libffi, self.build_libxml, self.install_path())
+
     def should_rebuild(self):
         # There's a way to force rebuilding of dependencies
         if os.environ.get('FORCE_WHEEL_REBUILD') == 'true':
@@ -267,9 +290,7 @@ class PythonDependencyBuilder(object):
         with open(sha1sum_file, 'r') as fp:
             sha1sum = fp.read().strip()
 
-        requirements_file = os.path.join(self.lambda_path, 'requirements.txt')
-        with open(requirements_file, 'r') as fp:
-            calculated_sha1sum = sha1(fp.read().encode('utf-8')).hexdigest()
+        calculated_sha1sum = self.requirements_sha1()
 
         if sha1sum != calculated_sha1sum:
             LOG.warning("SHA1 mismatch, rebuilding dependencies.")
@@ -278,15 +299,18 @@ class PythonDependencyBuilder(object):
             LOG.warning("SHA1 match, skip building dependencies.")
             return False
 
+    @trace.traced('dependencies.build')
     def build(self):
         try:
             # Allow connecting to older Docker versions (e.g. CircleCI 1.0)
-            client = docker.from_env(version='auto')
+            client = docker_from_env()
         except Exception:
             LOG.error("Docker is not running, or it's outdated.")
             raise
 
-        if not self.should_rebuild():
+        rebuild = self.should_rebuild()
+        trace.annotate(rebuild=rebuild)
+        if not rebuild:
             # Even if we don't have to rebuild the dependencies, we still have
             # to install them, so that they can be picked up into the bundle.
             self._install_dependencies(client)
@@ -326,6 +350,7 @@ class PythonDependencyBuilder(object):
 
         self._install_dependencies(client)
 
+    @trace.traced('dependencies.install')
     def _install_dependencies(self, docker_client):
         LOG.warning('Installing dependencies...')
         install_script_path = self.generate_install_script()
@@ -357,9 +382,7 @@ class PythonDependencyBuilder(object):
             export_installed_dependencies(
                 container,
                 self.install_dir,
-                os.path.abspath(
-                    os.path.join(self.project_path, self.install_dir)
-                ),
+                self.install_path(),
             )
             remove_container(container)
         finally:
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import errno
+from hashlib import sha256
+import json
+import logging
+import os
+from tempfile import mkstemp
+
+LOG = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = '.yoke'
+
+
+def cache_enabled():
+    # Same convention as FORCE_WHEEL_REBUILD: an env variable set to 'true'.
+    return os.environ.get('YOKE_NO_CACHE') != 'true'
+
+
+def cache_root(project_dir):
+    return os.environ.get('YOKE_CACHE_DIR') or os.path.join(project_dir,
+                                                            CACHE_DIR_NAME)
+
+
+def cache_dir(project_dir, *parts):
+    path = os.path.join(cache_root(project_dir), *parts)
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def fingerprint(*parts):
+    digest = sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode('utf-8')
+        digest.update(part)
+        # Separate parts so that ('ab', 'c') and ('a', 'bc') differ.
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def read_json(path, ordered=False):
+    """The JSON document in `path`, or None if it can't be read. With
+    `ordered`, objects are loaded as OrderedDicts."""
+    try:
+        with open(path, 'r') as fp:
+            return json.load(
+                fp, object_pairs_hook=OrderedDict if ordered else None)
+    except (IOError, OSError, ValueError) as exc:
+        if os.path.exists(path):
+            LOG.debug("Ignoring unreadable cache file %s: %s", path, exc)
+        return None
+
+
+def write_json(path, data, sort_keys=True):
+    write_bytes(path, json.dumps(data, sort_keys=sort_keys).encode('utf-8'))
+
+
+def write_bytes(path, data):
+    # Write to a temporary file next to the target and rename it into place,
+    # so concurrent yoke runs never see a half-written cache file.
+    fd, tmp_path = mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        os.chmod(tmp_path, 0o600)
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
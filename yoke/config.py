@@ -1,15 +1,22 @@
-import boto3
-from botocore.exceptions import ClientError
+from collections import OrderedDict
+import errno
 import json
 import logging
 import os
 import re
-import ruamel.yaml as yaml
 
+from . import __version__
+from . import aws
+from . import cache
+from . import trace
 from . import utils
 
 LOG = logging.getLogger(__name__)
+# Placeholders in yoke.yml look like `{{ VAR }}`, with exactly one space.
+PLACEHOLDER_RE = re.compile(r'\{\{ (.*?) \}\}')
 LAMBDA_ROLE_ARN_TEMPLATE = "arn:aws:iam::{account_id}:role/{role}"
+# Bump this whenever the layout of the snapshotted config changes.
+SNAPSHOT_FORMAT = 3
 
 
 class YokeConfig(object):
@@ -20,8 +27,12 @@ class YokeConfig(object):
         self.stage = stage
         self.env_dict = env_dict
         self.yoke_path = os.path.join(self.project_dir, 'yoke.yml')
+        self._snapshot_path = None
 
     def check_default_stage(self, config, stage):
+        # Remember which section of yoke.yml the stage came from, so it can
+        # be written back to (e.g. by `yoke encrypt --in-place`).
+        config['stage_key'] = stage
         # Set provided stage's config to default configs
         if stage == 'default':
             config['stages'][self.stage] = config['stages'][stage]
@@ -36,10 +47,18 @@ class YokeConfig(object):
         config['stage'] = self.stage
         return config
 
+    @trace.traced('config.get_config')
     def get_config(self, skip_decrypt=False):
-        config = self.load_config_file()
-        stage = self.get_stage(self.stage, config)
-        config = self.check_default_stage(config, stage)
+        config = self.load_snapshot()
+        if config is None:
+            config = self.load_config_file()
+            stage = self.get_stage(self.stage, config)
+            config = self.check_default_stage(config, stage)
+            self.save_snapshot(config)
+        else:
+            # `render_config` adds the stage to the environment and that is
+            # expected to end up in the stage config below.
+            self.env_dict['stage'] = self.stage
 
         config['project_dir'] = self.project_dir
         config['account_id'] = self.get_account_id()
@@ -57,10 +76,11 @@ class YokeConfig(object):
             config['stages'][self.stage]['config'].update(self.env_dict)
 
         # Set proper Lambda ARN for role
-        config['Lambda']['config']['role'] = LAMBDA_ROLE_ARN_TEMPLATE.format(
-            account_id=config['account_id'],
-            role=config['Lambda']['config']['role']
-        )
+        for function in utils.get_functions(config):
+            function['config']['role'] = LAMBDA_ROLE_ARN_TEMPLATE.format(
+                account_id=config['account_id'],
+                role=function['config']['role']
+            )
 
         LOG.info('Config:\n%s', json.dumps(config, indent=4))
         return config
@@ -98,38 +118,158 @@ class YokeConfig(object):
 
         return stage
 
+    @trace.traced('config.account_id')
     def get_account_id(self):
         LOG.warning('Getting AWS Account Credentials ...')
-        try:
-            aws_account_id = boto3.client('iam').get_user()[
-                'User']['Arn'].split(':')[4]
-        except ClientError as exc:
-            LOG.debug("Failed to get account via get_user()...\n %s",
-                      str(exc))
-            aws_account_id = boto3.client('sts').get_caller_identity()[
-                'Account']
+        return aws.get_account_id()
+
+    def snapshot_path(self):
+        if self._snapshot_path:
+            return self._snapshot_path
+        with open(self.yoke_path, 'rb') as config_file:
+            raw = config_file.read()
+        env = json.dumps(sorted(
+            (k, v) for k, v in self.env_dict.items() if k != 'stage'))
+        key = cache.fingerprint(__version__, str(SNAPSHOT_FORMAT), raw, env,
+                                self.stage)
+        # Snapshots for the same project and stage share a prefix, so stale
+        # ones can be removed whenever a new one is written, even when
+        # several projects share YOKE_CACHE_DIR.
+        prefix = cache.fingerprint(os.path.abspath(self.yoke_path),
+                                   self.stage)[:16]
+        snapshot_dir = cache.cache_dir(self.project_dir, 'config')
+        self._snapshot_path = os.path.join(snapshot_dir,
+                                           '{}-{}.json'.format(prefix, key))
+        return self._snapshot_path
 
-        return str(aws_account_id)
+    def load_snapshot(self):
+        if not cache.cache_enabled():
+            return None
+        # The key order of yoke.yml ends up in lambda.json and config.json,
+        # and so in the package's hash.
+        snapshot = cache.read_json(self.snapshot_path(), ordered=True)
+        if not snapshot or snapshot.get('format') != SNAPSHOT_FORMAT:
+            return None
+        LOG.warning("Using compiled config snapshot for stage %s ...",
+                    self.stage)
+        trace.annotate(cache_hits=1)
+        return snapshot['config']
 
+    def save_snapshot(self, config):
+        # Only ever called before `secretConfig` is decrypted and merged into
+        # the stage config, so the snapshot holds ciphertext only.
+        if not cache.cache_enabled():
+            return
+        try:
+            if json.loads(json.dumps(config)) != config:
+                LOG.debug("Config does not survive a JSON round trip, not "
+                          "writing a snapshot.")
+                return
+        except (TypeError, ValueError):
+            return
+        path = self.snapshot_path()
+        prefix = os.path.basename(path).split('-')[0]
+        snapshot_dir = os.path.dirname(path)
+        for name in os.listdir(snapshot_dir):
+            if name.startswith(prefix + '-'):
+                try:
+                    os.remove(os.path.join(snapshot_dir, name))
+                except OSError as exc:
+                    # Another yoke run got there first.
+                    if exc.errno != errno.ENOENT:
+                        raise
+        cache.write_json(path, OrderedDict([('format', SNAPSHOT_FORMAT),
+                                            ('config', config)]),
+                         sort_keys=False)
+
+    @trace.traced('config.render')
     def load_config_file(self):
-        # Read config file lines as list in order to template.
+        # Template the config file while the YAML loader is reading it.
         LOG.warning("Getting config from %s ...", self.project_dir)
         with open(self.yoke_path, 'r') as config_file:
-            raw = config_file.readlines()
-        raw = self.render_config(raw)
-        return yaml.safe_load(raw)
+            stream = RenderedConfig(config_file, self.render_vars())
+            try:
+                return utils.load_yaml(stream)
+            finally:
+                # Report every missing variable at once, even if the YAML
+                # loader gave up half way through the file.
+                stream.read()
+                stream.check()
 
     def render_config(self, config):
+        stream = RenderedConfig(config, self.render_vars())
+        rendered = stream.read()
+        stream.check()
+        LOG.debug("Rendered config:\n{}".format(rendered))
+        return rendered
+
+    def render_vars(self):
         vars = self.env_dict
         vars['stage'] = self.stage
-        rendered = []
-        p = re.compile(".*?\{\{ (.*?) \}\}.*?")
-        for line in config:
-            match = p.findall(line)
-            for var in match:
-                replace_var = self.env_dict[var]
-                line = line.replace("{{{{ {} }}}}".format(var),
-                                    replace_var, 1)
-            rendered.append(line)
-        LOG.debug("Rendered config:\n{}".format(rendered))
-        return ''.join(rendered)
+        return vars
+
+
+class MissingVariablesError(KeyError):
+
+    def __init__(self, missing):
+        super(MissingVariablesError, self).__init__(missing)
+        self.missing = missing
+
+    def __str__(self):
+        lines = OrderedDict()
+        for lineno, var in self.missing:
+            lines.setdefault(var, []).append(str(lineno))
+        return 'Missing template variables in yoke.yml: {}'.format(
+            ', '.join('{} ({} {})'.format(
+                var, 'line' if len(linenos) == 1 else 'lines',
+                ', '.join(linenos)) for var, linenos in lines.items()))
+
+
+class RenderedConfig(object):
+    """Read-only file-like object that substitutes `{{ VAR }}` placeholders
+    in a single pass over the lines of `source`.
+
+    Missing variables are left untouched and collected in `missing`, so all
+    of them can be reported together by `check()`.
+    """
+
+    def __init__(self, source, variables):
+        self._lines = iter(source)
+        self._vars = variables
+        self._buffer = ''
+        self._lineno = 0
+        self.missing = []
+
+    def _render_line(self, line):
+        self._lineno += 1
+        if '{{' not in line:
+            return line
+        return PLACEHOLDER_RE.sub(self._substitute, line)
+
+    def _substitute(self, match):
+        var = match.group(1)
+        try:
+            return self._vars[var]
+        except KeyError:
+            self.missing.append((self._lineno, var))
+            return match.group(0)
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        for line in self._lines:
+            line = self._render_line(line)
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            self._buffer = ''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+    def check(self):
+        if self.missing:
+            raise MissingVariablesError(self.missing)
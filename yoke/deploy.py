@@ -1,64 +1,436 @@
+import base64
+import binascii
 from collections import namedtuple, OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
 import copy
+from hashlib import sha256
 import logging
 import json
 import os
 import re
+import sys
+import threading
+import time
 
-import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
-from jinja2 import Environment, DictLoader, FileSystemLoader
-import jsonref
-from lambda_uploader import package, uploader
-from retrying import retry
-import ruamel.yaml as yaml
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from six import string_types
 
+from . import api_patch
+from . import aws
 from .build_deps import PythonDependencyBuilder
+from . import cache
+from . import import_profile
+from . import optimize
+from . import packager
+from . import refs
+from . import sizes
+from .pipeline import DEFAULT_WORKERS, Pipeline
+from .throttle import SCHEDULER
+from . import trace
 from . import templates
 from . import utils
 
 LOG = logging.getLogger(__name__)
 
 API_GATEWAY_URL_TEMPLATE = "https://{}.execute-api.{}.amazonaws.com/{}"
+API_GATEWAY_ARN_TEMPLATE = "arn:aws:apigateway:{}::/restapis/{}"
+API_FINGERPRINT_TAG = 'yoke:swaggerSha256'
+API_INDEX_TTL = 3600
+API_PAGE_SIZE = 500
+API_MAX_PATCHES = 25
+HASH_CHUNK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+S3_CONCURRENCY = 10
+S3_PART_SIZE_MB = 8
+REGION_POLICIES = ('fail-fast', 'continue')
+JINJA_MARKERS = ('{{', '{%', '{#')
 
+_JINJA_LOCK = threading.Lock()
+_JINJA_ENVIRONMENTS = {}
+# (account id, region) pairs whose credentials were already checked, every
+# Deployment of a function and region checks them otherwise.
+_ACCOUNT_LOCK = threading.Lock()
+_VERIFIED_ACCOUNTS = set()
 
-def build(config):
+
+def build(config, workers=None, size_report=None):
     LOG.warning('Building deployment only ...')
-    deployment = Deployment(config)
-    deployment.write_lambda_json()
-    deployment.write_lambda_config()
+    configs = function_configs(config)
+    deployments = [Deployment(function_config)
+                   for function_config in configs]
+    for deployment in deployments:
+        deployment.write_lambda_files()
     if config.get('apiGateway'):
-        template = deployment.render_swagger()
-        swagger_file = deployment.write_template(template)
-        # Also write the deref'd JSON version
-        deployment.deref(template)
-        LOG.warning('API Gateway Swagger file written to {}'.format(
-                    swagger_file))
+        for region in get_regions(config):
+            region_deployment = Deployment(configs[0], region=region)
+            template = region_deployment.render_swagger()
+            swagger_file = region_deployment.write_swagger(
+                template, region_deployment.deref(template))
+            LOG.warning('API Gateway Swagger file written to {}'.format(
+                        swagger_file))
 
-    deployment.build_lambda_package()
+    pkgs = build_packages(deployments, workers=workers)
+    reports = [deployment.size_report(pkg)
+               for deployment, pkg in zip(deployments, pkgs)]
+    for report in reports:
+        print(sizes.format_report(report))
+    if size_report:
+        with open(size_report, 'w') as fh:
+            json.dump({'packages': reports}, fh, indent=2)
+        LOG.warning('Package size report written to %s', size_report)
 
 
-def build_dependencies(config):
+@trace.traced('deploy.build_dependencies')
+def build_dependencies(config, workers=None):
     LOG.warning('Building dependencies only ...')
-    deployment = Deployment(config)
-    deployment.build_dependencies()
+    deployments = [Deployment(function_config)
+                   for function_config in function_configs(config)]
+    run_dependency_builds(dependency_builders(deployments), workers=workers)
 
 
-def deploy_app(config):
-    deployment = Deployment(config)
-    deployment.deploy_lambda()
-    if config.get('apiGateway'):
-        deployment.deploy_api()
+def dependency_builders(deployments):
+    """One dependency builder per distinct set of dependencies. Functions
+    with the same requirements share a single build, functions installing
+    different ones into the same directory are an error."""
+    builders = OrderedDict()
+    install_paths = {}
+    for deployment in deployments:
+        builder = deployment.dependency_builder()
+        if builder is None:
+            continue
+        key = builder.build_key()
+        if key in builders:
+            continue
+        other = install_paths.setdefault(builder.install_path(),
+                                         builder.service_name)
+        if other != builder.service_name:
+            raise Exception(
+                "Functions {} and {} install different dependencies into "
+                "{}".format(other, builder.service_name,
+                            builder.install_path()))
+        builders[key] = builder
+    return list(builders.values())
+
+
+def run_dependency_builds(builders, workers=None):
+    if not builders:
+        return
+    if len(builders) > 1:
+        LOG.warning("Building %s dependency sets ...", len(builders))
+    with ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS) as pool:
+        # list() to raise the first exception, if any.
+        list(pool.map(lambda builder: builder.build(), builders))
+
+
+def build_packages(deployments, workers=None, skip_if_exists=False):
+    """Build the Lambda package of every deployment. Their dependencies are
+    built first, before any package reads them."""
+    # Leaving this here for backward-compatibility reasons. More recent
+    # versions of Yoke might want to call the `build-dependencies` command
+    # separately. If that's the case, this won't do too much, because the
+    # built packages already exist and are up-to-date.
+    pending = [deployment for deployment in deployments
+               if not (skip_if_exists and deployment.package_exists())]
+    run_dependency_builds(dependency_builders(pending), workers=workers)
+    if len(deployments) == 1:
+        return [deployments[0].build_lambda_package(skip_if_exists)]
+    with ThreadPoolExecutor(max_workers=workers or DEFAULT_WORKERS) as pool:
+        return list(pool.map(
+            lambda deployment: deployment.build_lambda_package(
+                skip_if_exists),
+            deployments))
+
+
+@trace.traced('deploy.verify_account_id')
+def verify_account_id(account_id, region):
+    """Check that the credentials belong to the account from yoke.yml, once
+    per region for every deployment in it."""
+    with _ACCOUNT_LOCK:
+        if (account_id, region) in _VERIFIED_ACCOUNTS:
+            return
+        LOG.warning('Verifying AWS Account Credentials for %s ...', region)
+
+        aws_account_id = aws.get_account_id()
+        try:
+            assert aws_account_id == account_id
+        except Exception:
+            LOG.error('yoke.yml accountId (%s) does not match credentials '
+                      'account (%s)!', account_id, aws_account_id)
+            raise
+        _VERIFIED_ACCOUNTS.add((account_id, region))
+
+
+def function_configs(config):
+    """One config per Lambda function, with that function as its `Lambda`
+    section."""
+    configs = []
+    paths = set()
+    for function in utils.get_functions(config):
+        path = os.path.abspath(os.path.join(config['project_dir'],
+                                            function['path']))
+        if path in paths:
+            raise Exception("Every function needs its own path, {} is used "
+                            "more than once.".format(function['path']))
+        paths.add(path)
+        function_config = dict(config)
+        function_config['Lambda'] = function
+        configs.append(function_config)
+    return configs
+
+
+def profile_imports(config, python=None, runs=import_profile.DEFAULT_RUNS,
+                    min_ms=import_profile.DEFAULT_MIN_MS):
+    deployments = [Deployment(function_config)
+                   for function_config in function_configs(config)]
+    for deployment in deployments:
+        deployment.write_lambda_files()
+    pkgs = build_packages(deployments, skip_if_exists=True)
+    for deployment, pkg in zip(deployments, pkgs):
+        print(deployment.profile_imports(pkg, python=python, runs=runs,
+                                         min_ms=min_ms))
+
+
+def deploy_app(config, force=False, workers=None, timings=False,
+               swagger_files=True):
+    if len(get_regions(config)) > 1 or len(utils.get_functions(config)) > 1:
+        return deploy_regions(config, force=force, workers=workers,
+                              timings=timings, swagger_files=swagger_files)
+    deployment = Deployment(config, force=force)
+    pipeline = deployment.deploy_pipeline(workers=workers,
+                                          swagger_files=swagger_files)
+    try:
+        pipeline.run()
+    finally:
+        if timings:
+            print(pipeline.format_timings())
+        SCHEDULER.report()
     LOG.warning('Deployment complete!')
 
 
+def deploy_regions(config, force=False, workers=None, timings=False,
+                   swagger_files=True):
+    """Build every Lambda package once, then upload and publish them to every
+    region of the stage concurrently."""
+    regions = get_regions(config)
+    stage = config['stages'][config['stage']]
+    policy = stage.get('regionPolicy', 'fail-fast')
+    if policy not in REGION_POLICIES:
+        raise Exception("Invalid regionPolicy {}, expected one of: {}".format(
+            policy, ', '.join(REGION_POLICIES)))
+    concurrency = int(stage.get('regionConcurrency') or len(regions))
+
+    LOG.warning("Deploying to regions %s ...", ', '.join(regions))
+    configs = function_configs(config)
+    builders = [Deployment(function_config, force=force)
+                for function_config in configs]
+    for builder in builders:
+        builder.write_lambda_files()
+    pkgs = build_packages(builders, workers=workers, skip_if_exists=True)
+
+    def deploy_region(region):
+        started = time.time()
+        # Each region mutates its own copy of the config, see
+        # `create_upldr_config`.
+        deployments = [Deployment(copy.deepcopy(function_config),
+                                  region=region, force=force)
+                       for function_config in configs]
+        pipeline = Pipeline(workers=workers)
+        uploads = [deployment.add_lambda_tasks(pipeline, pkg=pkg)
+                   for deployment, pkg in zip(deployments, pkgs)]
+        if config.get('apiGateway'):
+            deployments[0].add_api_tasks(pipeline, uploads,
+                                         swagger_files=swagger_files)
+        try:
+            pipeline.run()
+        finally:
+            if timings:
+                print("Region {}:\n{}".format(
+                    region, pipeline.format_timings()))
+        return time.time() - started
+
+    results = OrderedDict((region, None) for region in regions)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = dict((executor.submit(deploy_region, region), region)
+                       for region in regions)
+        for future in as_completed(futures):
+            region = futures[future]
+            if future.cancelled():
+                continue
+            if future.exception() is None:
+                results[region] = ('deployed', future.result())
+                continue
+            LOG.error("Deployment to %s failed: %s", region,
+                      future.exception())
+            results[region] = ('failed', future.exception())
+            if policy == 'fail-fast':
+                for other in futures:
+                    if other.cancel():
+                        results[futures[other]] = ('cancelled', None)
+    for pkg in pkgs:
+        pkg.clean_zipfile()
+    SCHEDULER.report()
+
+    for region, (status, detail) in results.items():
+        if status == 'deployed':
+            LOG.warning("%-16s deployed in %.2fs", region, detail)
+        else:
+            LOG.warning("%-16s %s", region, status)
+    failed = [region for region, (status, _) in results.items()
+              if status != 'deployed']
+    if failed:
+        raise Exception("Deployment failed in regions: {}".format(
+            ', '.join(failed)))
+    LOG.warning('Deployment complete!')
+
+
+def swagger_environment(project_dir):
+    """Jinja environment for the Swagger templates of a project, shared by
+    every deployment. Compiled templates are kept in the yoke cache."""
+    with _JINJA_LOCK:
+        if project_dir not in _JINJA_ENVIRONMENTS:
+            bytecode_cache = None
+            if cache.cache_enabled():
+                bytecode_cache = FileSystemBytecodeCache(
+                    cache.cache_dir(project_dir, 'jinja'))
+            _JINJA_ENVIRONMENTS[project_dir] = Environment(
+                loader=FileSystemLoader(project_dir), trim_blocks=True,
+                lstrip_blocks=True, bytecode_cache=bytecode_cache)
+        return _JINJA_ENVIRONMENTS[project_dir]
+
+
+def render_strings(data, context):
+    """Render every string in `data` that contains Jinja markup. Keys that
+    aren't strings are converted like `json.dumps` would."""
+    environment = Environment(keep_trailing_newline=True)
+    rendered = {}
+
+    def render(value):
+        if isinstance(value, dict):
+            return dict((render(key if isinstance(key, string_types)
+                                else json.dumps(key)), render(item))
+                        for key, item in value.items())
+        if isinstance(value, list):
+            return [render(item) for item in value]
+        if not isinstance(value, string_types) or not any(
+                marker in value for marker in JINJA_MARKERS):
+            return value
+        # The same integration strings show up for every method.
+        if value not in rendered:
+            rendered[value] = environment.from_string(value).render(
+                **context)
+        return rendered[value]
+
+    return render(data)
+
+
+def get_regions(config):
+    stage = config['stages'][config['stage']]
+    return stage.get('regions') or [stage['region']]
+
+
+def canonical_json(body):
+    return json.dumps(body, sort_keys=True, separators=(',', ':'))
+
+
+def get_rest_api(client, api_id):
+    try:
+        return client.get_rest_api(restApiId=api_id)
+    except ClientError as exc:
+        if exc.response['Error']['Code'] == 'NotFoundException':
+            return None
+        raise
+
+
+def list_rest_apis(client):
+    paginator = client.get_paginator('get_rest_apis')
+    items = []
+    for page in paginator.paginate(
+            PaginationConfig={'PageSize': API_PAGE_SIZE}):
+        items.extend(page.get('items', []))
+    return items
+
+
+def get_function_configuration(client, name, qualifier=None):
+    kwargs = {'FunctionName': name}
+    if qualifier:
+        kwargs['Qualifier'] = qualifier
+    try:
+        return client.get_function_configuration(**kwargs)
+    except ClientError as exc:
+        if exc.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+
+
+def lambda_config_changed(live, upldr_config):
+    wanted = lambda_configuration(upldr_config)
+    for key in ('Handler', 'Role', 'Description', 'Timeout', 'MemorySize',
+                'Runtime'):
+        if live.get(key) != wanted[key]:
+            return True
+    live_vpc = live.get('VpcConfig') or {}
+    for key in ('SubnetIds', 'SecurityGroupIds'):
+        if sorted(live_vpc.get(key) or []) != sorted(wanted['VpcConfig'][key]):
+            return True
+    live_variables = (live.get('Environment') or {}).get('Variables') or {}
+    if live_variables != wanted['Environment']['Variables']:
+        return True
+    live_tracing = (live.get('TracingConfig') or {}).get(
+        'Mode', 'PassThrough')
+    return live_tracing != wanted['TracingConfig'].get('Mode', 'PassThrough')
+
+
+def lambda_configuration(upldr_config):
+    # Mirrors what lambda-uploader used to send with
+    # update_function_configuration.
+    vpc = upldr_config.raw['vpc']
+    return {
+        'Handler': upldr_config.handler,
+        'Role': upldr_config.role,
+        'Description': upldr_config.description,
+        'Timeout': upldr_config.timeout,
+        'MemorySize': upldr_config.memory,
+        'VpcConfig': {
+            'SubnetIds': vpc['subnets'] if vpc else [],
+            'SecurityGroupIds': vpc['security_groups'] if vpc else [],
+        },
+        'Environment': {'Variables': upldr_config.variables},
+        'TracingConfig': upldr_config.tracing,
+        'Runtime': upldr_config.runtime,
+    }
+
+
+def package_sha256(zip_file):
+    # Lambda reports CodeSha256 as the base64 encoded SHA-256 of the zip.
+    digest = sha256()
+    with open(zip_file, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('utf-8')
+
+
+def wait_for_function_update(client, name):
+    # Newer versions of Lambda reject further updates while one is still in
+    # progress. Older botocore releases don't have this waiter.
+    if 'function_updated' in client.waiter_names:
+        client.get_waiter('function_updated').wait(FunctionName=name)
+
+
 class Deployment(object):
 
-    def __init__(self, config):
+    def __init__(self, config, force=False, region=None):
         self.config = config
+        self.force = force
+        self.api = None
         self.project_dir = self.config['project_dir']
         self.stage = config['stage']
-        self.region = self.config['stages'][self.stage]['region']
+        self.region = region or get_regions(config)[0]
+        # Files written per region get the region in their name.
+        self.multi_region = len(get_regions(config)) > 1
+        self.function_count = len(utils.get_functions(config))
+        self.package_report = None
         self.lambda_path = os.path.abspath(os.path.join(self.project_dir,
                                            self.config['Lambda']['path']))
         self.account_id = config['account_id']
@@ -66,7 +438,7 @@ class Deployment(object):
         self.ignore = self.normalize_files('ignore',
                                            config['Lambda']['config'])
         # Let's make sure the accounts match up
-        self.verify_account_id()
+        verify_account_id(self.account_id, self.region)
 
     def apply_templates(self, template):
         aws_int = 'x-amazon-apigateway-integration'
@@ -79,7 +451,7 @@ class Deployment(object):
                             _config['x-yoke-integration'])
         return template
 
-    def build_dependencies(self):
+    def dependency_builder(self):
         dependency_config = self.config['Lambda'].get('dependencies')
         if dependency_config is None:
             LOG.warning(
@@ -117,7 +489,7 @@ class Deployment(object):
                         ),
                     )
                 install_dir = dependency_config.get('install_dir') or './lib'
-                builder = PythonDependencyBuilder(
+                return PythonDependencyBuilder(
                     runtime=runtime,
                     project_path=self.project_dir,
                     wheelhouse_path=wheelhouse_path,
@@ -129,17 +501,25 @@ class Deployment(object):
                     build_libffi=dependency_config.get('libffi', False),
                     build_libxml=dependency_config.get('libxml', False),
                 )
-                builder.build()
+        return None
+
+    def package_exists(self):
+        return os.path.isfile(
+            packager.LambdaPackage(self.lambda_path).zip_file)
 
+    @trace.traced('deploy.build_package')
     def build_lambda_package(self, skip_if_exists=False):
+        """Build the package from the function's path and extra files. The
+        dependencies have to be built already, see `build_packages`."""
         LOG.warning("Building Lambda package ...")
-        pkg = package.Package(self.lambda_path)
-        pkg._requirements_file = None
+        pkg = packager.LambdaPackage(self.lambda_path)
         if os.path.isfile(pkg.zip_file):
             if skip_if_exists:
                 # Package already built, don't do anything else
                 LOG.warning(
                     "Lambda package already built, using existing file.")
+                trace.annotate(cache_hits=1)
+                self.check_size_budget(pkg)
                 return pkg
             else:
                 # Otherwise we should delete the existing file, otherwise it
@@ -147,20 +527,110 @@ class Deployment(object):
                 LOG.warning("Removing existing Lambda package.")
                 os.remove(pkg.zip_file)
 
-        # Leaving this here for backward-compatibility reasons. More recent
-        # versions of Yoke might want to call the `build-dependencies` command
-        # separately. If that's the case, this code below will not do too much,
-        # because the built packages already exist and are up-to-date.
-        self.build_dependencies()
-
-        if self.extra_files:
-            for _file in self.extra_files:
-                pkg.extra_file(_file)
-        pkg._prepare_workspace()
-        pkg.package(self.ignore)
-        pkg.clean_workspace()
+        # The package is zipped straight from the source files, the yoke
+        # cache is the only thing that must never end up in it.
+        entries = packager.collect_entries(
+            self.lambda_path, self.extra_files, self.ignore,
+            exclude=[pkg.zip_file, cache.cache_root(self.project_dir)])
+        package_config = self.config['Lambda'].get('package') or {}
+        builder = packager.ZipBuilder(
+            pkg.zip_file,
+            cache_dir=self.cache_dir(),
+            level=package_config.get('compressionLevel',
+                                     packager.COMPRESS_LEVEL),
+            workers=package_config.get('workers'),
+        )
+        self.package_report = None
+        optimizer = self.optimizer()
+        if optimizer is None:
+            builder.build(entries)
+        else:
+            try:
+                builder.build(optimizer.optimize(entries))
+                optimizer.report(pkg.zip_file)
+            except Exception:
+                # Don't leave a package that failed its import check for
+                # the next build or deploy to reuse.
+                pkg.clean_zipfile()
+                raise
+            finally:
+                optimizer.close()
+        self.check_size_budget(pkg)
         return pkg
 
+    def profile_imports(self, pkg, python=None,
+                        runs=import_profile.DEFAULT_RUNS,
+                        min_ms=import_profile.DEFAULT_MIN_MS):
+        """Import time report for the handler in `pkg`, compared with the
+        last profile of a different package."""
+        lambda_config = self.config['Lambda']['config']
+        if python is None and not optimize.runtime_matches(
+                lambda_config.get('runtime', 'python2.7')):
+            LOG.warning("Profiling with Python %s.%s, not %s like Lambda "
+                        "will.", sys.version_info[0], sys.version_info[1],
+                        lambda_config.get('runtime', 'python2.7'))
+        LOG.warning("Profiling imports of %s ...", lambda_config['handler'])
+        modules = import_profile.profile_package(
+            pkg.zip_file, lambda_config['handler'], python=python, runs=runs)
+        summary = import_profile.summarize(
+            modules,
+            import_profile.module_owners(self.lambda_path, self.extra_files))
+        summary['package'] = package_sha256(pkg.zip_file)
+
+        previous = None
+        if cache.cache_enabled():
+            path = os.path.join(cache.cache_dir(self.project_dir, 'imports'),
+                                '{}.json'.format(cache.fingerprint(
+                                    self.lambda_path)[:16]))
+            history = cache.read_json(path) or {}
+            current = history.get('current')
+            if current and current.get('package') != summary['package']:
+                history['previous'] = current
+            previous = history.get('previous')
+            history['current'] = summary
+            cache.write_json(path, history)
+        return import_profile.format_report(modules, summary, previous,
+                                            min_ms=min_ms)
+
+    def size_report(self, pkg):
+        if self.package_report is None:
+            self.package_report = sizes.package_report(
+                pkg.zip_file, self.lambda_path, self.extra_files,
+                name=self.config['Lambda']['config']['name'])
+        return self.package_report
+
+    def check_size_budget(self, pkg):
+        budget = self.config['Lambda'].get('sizeBudget')
+        if not budget:
+            return
+        report = self.size_report(pkg)
+        exceeded = sizes.over_budget(report, budget)
+        if exceeded:
+            print(sizes.format_report(report))
+            raise Exception("Lambda package {} exceeds its size budget:\n  "
+                            "{}".format(report['function'],
+                                        '\n  '.join(exceeded)))
+
+    def optimizer(self):
+        options = optimize.get_options(self.config['Lambda'])
+        if options is None:
+            return None
+        work_dir = None
+        if cache.cache_enabled():
+            # One directory per Lambda path, pruned after every build.
+            work_dir = cache.cache_dir(
+                self.project_dir, 'optimize',
+                cache.fingerprint(self.lambda_path)[:16])
+        lambda_config = self.config['Lambda']['config']
+        return optimize.Optimizer(
+            options, lambda_config.get('runtime', 'python2.7'),
+            lambda_config.get('handler'), work_dir=work_dir)
+
+    def cache_dir(self):
+        if cache.cache_enabled():
+            return cache.cache_dir(self.project_dir, 'package')
+        return None
+
     def create_upldr_config(self):
         Lambda = self.config['Lambda']
         Lambda['config']['s3_bucket'] = None
@@ -179,37 +649,113 @@ class Deployment(object):
         upldr_config = namedtuple('config', ordered.keys())(**ordered)
         return upldr_config
 
-    def deploy_lambda(self):
-        self.write_lambda_json()
-        self.write_lambda_config()
-        pkg = self.build_lambda_package(skip_if_exists=True)
-
-        # Create fake config for lambda uploader because
-        # it isn't completely ok with being used as a library.
-        upldr_config = self.create_upldr_config()
-
-        # Upload lambda
-        self.upload_lambda(pkg, upldr_config)
-
-    @retry(retry_on_exception=utils.retry_if_api_limit,
-           wait_exponential_multiplier=5000, wait_exponential_max=25000,
-           stop_max_attempt_number=10)
-    def deploy_api(self):
-
-        # Template swagger.yml from template
-        template = self.render_swagger()
-        self.write_template(template)
-
-        # Import/Update API from swagger.yml
-        # Convert to JSON and deref for AWS API compatibility.
-        upload_body = self.deref(template)
-        api = self.upload_api(upload_body)
-        LOG.warning("Deploying API to %s stage ...", self.stage)
-        client = boto3.client('apigateway', region_name=self.region)
-        deployment = client.create_deployment(
-            restApiId=api['id'],
-            stageName=self.stage)
-        LOG.warning("API deployed! URL:\n %s",
+    def deploy_pipeline(self, workers=None, pkg=None, swagger_files=True):
+        """Deployment steps as a task graph. Rendering the Swagger and
+        looking up the API overlap with building and uploading the Lambda
+        package, while the files are still written in the same order as a
+        sequential deployment."""
+        pipeline = Pipeline(workers=workers)
+        upload = self.add_lambda_tasks(pipeline, pkg=pkg)
+        if self.config.get('apiGateway'):
+            self.add_api_tasks(pipeline, [upload],
+                               swagger_files=swagger_files)
+        return pipeline
+
+    def task_name(self, name):
+        # Several functions can share one pipeline.
+        if self.function_count > 1:
+            return '{}[{}]'.format(name,
+                                   self.config['Lambda']['config']['name'])
+        return name
+
+    def add_lambda_tasks(self, pipeline, pkg=None):
+        """Add the tasks uploading this function, and return the name of the
+        last one. If `pkg` is given, it has already been built (along with
+        lambda.json and config.json) and is left in place after the
+        upload."""
+        name = self.task_name
+        if pkg is None:
+            pipeline.add(name('write_lambda_files'), self.write_lambda_files)
+            pipeline.add(
+                name('build_package'),
+                lambda: build_packages([self], skip_if_exists=True)[0],
+                deps=[name('write_lambda_files')])
+            files_deps = [name('write_lambda_files')]
+            build_deps = [name('build_package')]
+        else:
+            files_deps, build_deps = [], []
+        # Mutates the Lambda config, so it has to run after lambda.json is
+        # written and before the Swagger is rendered.
+        pipeline.add(name('upldr_config'), self.create_upldr_config,
+                     deps=files_deps)
+        pipeline.add(name('upload_lambda'),
+                     lambda: self.upload_lambda(
+                         pkg or pipeline.result(name('build_package')),
+                         pipeline.result(name('upldr_config')),
+                         clean=pkg is None),
+                     deps=build_deps + [name('upldr_config')])
+        return name('upload_lambda')
+
+    def add_api_tasks(self, pipeline, uploads, swagger_files=True):
+        """Add the tasks publishing the API, once all `uploads` are done.
+        The rendered Swagger is only written to the project directory if
+        `swagger_files` is set."""
+        name = self.task_name
+        build_deps = [task for task in [name('build_package')]
+                      if task in pipeline]
+        pipeline.add('render_swagger', self.render_swagger,
+                     deps=[name('upldr_config')])
+        pipeline.add('deref_swagger',
+                     lambda: self.deref(pipeline.result('render_swagger')),
+                     deps=['render_swagger'])
+        pipeline.add('find_api', self.resolve_api)
+        publish_deps = ['deref_swagger', 'find_api'] + list(uploads)
+        if swagger_files:
+            # The Lambda package is built from a directory that can contain
+            # the Swagger files, so only write them once it is done.
+            pipeline.add('write_swagger',
+                         lambda: self.write_swagger(
+                             pipeline.result('render_swagger'),
+                             pipeline.result('deref_swagger')),
+                         deps=['render_swagger', 'deref_swagger'] + build_deps)
+            publish_deps.append('write_swagger')
+        pipeline.add('publish_api',
+                     lambda: self.publish_api(
+                         pipeline.result('deref_swagger')),
+                     deps=publish_deps)
+
+    @trace.traced('deploy.resolve_api')
+    def resolve_api(self):
+        self.api = self.find_api(aws.get_client('apigateway', self.region))
+        if self.api:
+            LOG.warning('Found existing API: %s', self.api['name'])
+        return self.api
+
+    @trace.traced('deploy.publish_api')
+    def publish_api(self, swagger):
+        # Import/Update API from the deref'd swagger, as JSON.
+        upload_body = canonical_json(swagger)
+        fingerprint = sha256(upload_body.encode('utf-8')).hexdigest()
+        trace.annotate(bytes=len(upload_body))
+        api, imported = self.upload_api(upload_body, fingerprint)
+        client = aws.get_client('apigateway', self.region)
+        stage_arn = '{}/stages/{}'.format(
+            API_GATEWAY_ARN_TEMPLATE.format(self.region, api['id']),
+            self.stage)
+        if (not imported and
+                self.get_stage_fingerprint(client, api['id']) == fingerprint):
+            LOG.warning("API stage %s is already up to date, skipping "
+                        "deployment.", self.stage)
+            trace.annotate(cache_hits=1)
+            deployment = None
+        else:
+            LOG.warning("Deploying API to %s stage ...", self.stage)
+            deployment = client.create_deployment(
+                restApiId=api['id'],
+                stageName=self.stage)
+            client.tag_resource(resourceArn=stage_arn,
+                                tags={API_FINGERPRINT_TAG: fingerprint})
+        LOG.warning("API URL:\n %s",
                     API_GATEWAY_URL_TEMPLATE.format(api['id'],
                                                     self.region,
                                                     self.stage))
@@ -222,35 +768,24 @@ class Deployment(object):
             normalized.append(os.path.join(self.project_dir, a_file))
         return normalized
 
+    @trace.traced('deploy.render_swagger')
     def render_swagger(self):
         LOG.warning("Templating swagger.yml for region %s ...", self.region)
         swagger_file = self.config['apiGateway'].get('swaggerTemplate',
                                                      'template.yml')
-        j2_env = Environment(loader=FileSystemLoader(self.project_dir),
-                             trim_blocks=True, lstrip_blocks=True)
-        first_template = yaml.safe_load(
-            j2_env.get_template(swagger_file).render(
-                accountId=self.account_id,
-                Lambda=self.config['Lambda'],
-                apiGateway=self.config['apiGateway'],
-                region=self.region,
-                stage=self.stage))
-
-        integrations_template = self.apply_templates(first_template)
-
-        # We have to do this twice to template the integrations - I'm sorry.
-        j2_env = Environment(loader=DictLoader(
-            {'template': json.dumps(integrations_template)}))
-        j2_template = j2_env.get_template('template')
-        rendered_template = yaml.safe_load(j2_template.render(
+        context = dict(
             accountId=self.account_id,
             Lambda=self.config['Lambda'],
             apiGateway=self.config['apiGateway'],
             region=self.region,
-            stage=self.stage
-        ))
-
-        return rendered_template
+            stage=self.stage)
+        template = utils.load_yaml(
+            swagger_environment(self.project_dir).get_template(
+                swagger_file).render(**context))
+        # The integrations added here are templates themselves. Rendering
+        # the strings of the parsed tree does what rendering the whole
+        # document a second time would, without another parse.
+        return render_strings(self.apply_templates(template), context)
 
     def template_aws_integration(self, yoke_integration):
         integ = copy.deepcopy(templates.AWS_INTEGRATION)
@@ -272,60 +807,273 @@ class Deployment(object):
                                         operation, 1)
         return template
 
-    def upload_api(self, upload_body):
+    def get_stage_fingerprint(self, client, api_id):
+        if self.force:
+            return None
+        try:
+            stage = client.get_stage(restApiId=api_id, stageName=self.stage)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] == 'NotFoundException':
+                return None
+            raise
+        return stage.get('tags', {}).get(API_FINGERPRINT_TAG)
+
+    def find_api(self, client):
+        api_config = self.config['apiGateway']
+        if api_config.get('id'):
+            api = get_rest_api(client, api_config['id'])
+            if api is None:
+                raise Exception(
+                    "API {} not found in AWS Account {} for region "
+                    "{}".format(api_config['id'], self.account_id,
+                                self.region))
+            return api
+
+        # Try to find API by name, first in the cached index, then by
+        # listing every API in the account.
+        name = api_config['name']
+        index = self.read_api_index()
+        if index is not None and name in index:
+            api = get_rest_api(client, index[name])
+            if api is not None and api['name'] == name:
+                trace.annotate(cache_hits=1)
+                return api
+            LOG.warning("Cached id for API %s is stale, refreshing ...", name)
+        items = list_rest_apis(client)
+        matches = [item for item in items if item['name'] == name]
+        if len(matches) > 1:
+            LOG.warning("Found %s APIs named %s, using %s. Set "
+                        "apiGateway.id to pick one explicitly.",
+                        len(matches), name, matches[0]['id'])
+        index = {}
+        for item in items:
+            index.setdefault(item['name'], item['id'])
+        self.update_api_index(index, replace=True)
+        return matches[0] if matches else None
+
+    def api_index_path(self):
+        if not cache.cache_enabled():
+            return None
+        return os.path.join(
+            cache.cache_dir(self.project_dir, 'apis'),
+            '{}.json'.format(
+                cache.fingerprint(self.account_id, self.region)[:16]))
+
+    def read_api_index(self):
+        path = self.api_index_path()
+        data = cache.read_json(path) if path else None
+        if not data or time.time() - data['updated'] > API_INDEX_TTL:
+            return None
+        return data['apis']
+
+    def update_api_index(self, apis, replace=False):
+        path = self.api_index_path()
+        if path is None:
+            return
+        data = None if replace else cache.read_json(path)
+        if data is None:
+            data = {'updated': time.time(), 'apis': {}}
+        data['apis'].update(apis)
+        cache.write_json(path, data)
+
+    def upload_api(self, upload_body, fingerprint):
         LOG.warning("Uploading API to AWS Account %s for region %s ...",
                     self.account_id, self.region)
-        client = boto3.client('apigateway', region_name=self.region)
-
-        # Try to find API by name
-        apis = client.get_rest_apis()
-        apis = apis.get('items')
-        api = None
-        for item in apis:
-            if self.config['apiGateway']['name'] == item['name']:
-                LOG.warning('Found existing API: %s', item['name'])
-                api = item
-                break
+        client = aws.get_client('apigateway', self.region)
 
+        api = self.api
         parameters = {'basepath': 'prepend'}
         if api:
-            LOG.warning("API %s already exists - updating ...", api['name'])
-            api = client.put_rest_api(restApiId=api['id'],
-                                      mode='overwrite',
-                                      body=json.dumps(upload_body),
-                                      parameters=parameters)
+            # The fingerprint of the last imported body is kept as a tag on
+            # the API, so an unchanged Swagger doesn't need to be re-imported.
+            if (not self.force and
+                    api.get('tags', {}).get(API_FINGERPRINT_TAG) ==
+                    fingerprint):
+                LOG.warning("API %s is already up to date, skipping "
+                            "import.", api['name'])
+                trace.annotate(cache_hits=1)
+                return api, False
+            if not self.patch_api(client, api, upload_body):
+                LOG.warning("API %s already exists - updating ...",
+                            api['name'])
+                api = client.put_rest_api(restApiId=api['id'],
+                                          mode='overwrite',
+                                          body=upload_body,
+                                          parameters=parameters)
         else:
             LOG.warning("API %s not found, importing ...",
                         self.config['apiGateway']['name'])
-            api = client.import_rest_api(body=json.dumps(upload_body),
+            api = client.import_rest_api(body=upload_body,
                                          parameters=parameters)
+            self.update_api_index({api['name']: api['id']})
+
+        client.tag_resource(
+            resourceArn=API_GATEWAY_ARN_TEMPLATE.format(self.region,
+                                                        api['id']),
+            tags={API_FINGERPRINT_TAG: fingerprint})
+        self.save_api_body(api['id'], upload_body)
+        return api, True
+
+    def api_body_path(self, api_id):
+        if not cache.cache_enabled():
+            return None
+        return os.path.join(cache.cache_dir(self.project_dir, 'apis'),
+                            '{}.swagger.json'.format(api_id))
+
+    def save_api_body(self, api_id, upload_body):
+        path = self.api_body_path(api_id)
+        if path:
+            cache.write_bytes(path, upload_body.encode('utf-8'))
 
-        return api
+    def previous_api_body(self, api):
+        # The body imported by the last deploy from this machine, as long as
+        # it is still what the API holds according to its fingerprint tag.
+        path = self.api_body_path(api['id'])
+        if path is None or not os.path.exists(path):
+            return None
+        with open(path, 'rb') as fh:
+            previous = fh.read()
+        if (sha256(previous).hexdigest() !=
+                api.get('tags', {}).get(API_FINGERPRINT_TAG)):
+            return None
+        return json.loads(previous.decode('utf-8'))
 
-    def upload_lambda(self, pkg, upldr_config):
+    def patch_api(self, client, api, upload_body):
+        """Apply the changes since the last import as targeted integration
+        updates. Returns False if a full import is needed instead."""
+        if self.force:
+            return False
+        previous = self.previous_api_body(api)
+        if previous is None:
+            return False
+        body = json.loads(upload_body)
+        patches = api_patch.diff(previous, body)
+        if not patches or len(patches) > API_MAX_PATCHES:
+            return False
+        LOG.warning("API %s already exists - applying %s integration "
+                    "updates ...", api['name'], len(patches))
+        if not api_patch.apply(client, api['id'], body, patches):
+            LOG.warning("Couldn't update API %s in place, falling back to a "
+                        "full import.", api['name'])
+            return False
+        trace.annotate(patches=len(patches))
+        return True
+
+    @trace.traced('deploy.upload_lambda')
+    def upload_lambda(self, pkg, upldr_config, clean=True):
         LOG.warning("Uploading Lambda %s to AWS Account %s "
                     "for region %s ...",
                     upldr_config.name, self.account_id, upldr_config.region)
-        upldr = uploader.PackageUploader(upldr_config, None)
-        upldr.upload(pkg)
-        upldr.alias()
-        pkg.clean_zipfile()
+        client = aws.get_client('lambda', upldr_config.region)
+        code_sha256 = package_sha256(pkg.zip_file)
+        live = get_function_configuration(client, upldr_config.name,
+                                          qualifier=upldr_config.alias)
+        if (not self.force and live is not None and
+                live['CodeSha256'] == code_sha256 and
+                not lambda_config_changed(live, upldr_config)):
+            LOG.warning("Lambda %s:%s is already up to date, skipping "
+                        "upload.", upldr_config.name, upldr_config.alias)
+            trace.annotate(cache_hits=1)
+        else:
+            version = self.publish_lambda(client, pkg, upldr_config,
+                                          code_sha256)
+            self.alias_lambda(client, upldr_config, version,
+                              exists=live is not None)
+        if clean:
+            pkg.clean_zipfile()
 
-    def verify_account_id(self):
-        LOG.warning('Verifying AWS Account Credentials ...')
+    def publish_lambda(self, client, pkg, upldr_config, code_sha256):
+        # The alias is out of date, but $LATEST may already hold this code
+        # and config, e.g. when another stage deployed it.
+        latest = get_function_configuration(client, upldr_config.name)
+        if latest is None:
+            LOG.warning("Lambda %s not found, creating ...",
+                        upldr_config.name)
+            resp = client.create_function(
+                FunctionName=upldr_config.name,
+                Code=self.lambda_code(pkg, code_sha256),
+                Publish=True,
+                **lambda_configuration(upldr_config))
+            wait_for_function_update(client, upldr_config.name)
+            return resp['Version']
 
+        code_changed = latest['CodeSha256'] != code_sha256
+        config_changed = lambda_config_changed(latest, upldr_config)
+        version = None
+        if code_changed:
+            LOG.warning("Code changed, uploading %s ...", pkg.zip_file)
+            resp = client.update_function_code(
+                FunctionName=upldr_config.name,
+                Publish=not config_changed,
+                **self.lambda_code(pkg, code_sha256))
+            version = resp.get('Version')
+            wait_for_function_update(client, upldr_config.name)
+        if config_changed:
+            LOG.warning("Configuration changed, updating Lambda %s ...",
+                        upldr_config.name)
+            client.update_function_configuration(
+                FunctionName=upldr_config.name,
+                **lambda_configuration(upldr_config))
+            wait_for_function_update(client, upldr_config.name)
+        if not code_changed or config_changed:
+            # Publishing is a no-op returning the latest version if $LATEST
+            # has not changed since it was last published.
+            version = client.publish_version(
+                FunctionName=upldr_config.name,
+                CodeSha256=code_sha256,
+            )['Version']
+        return version
+
+    def alias_lambda(self, client, upldr_config, version, exists=True):
+        LOG.warning("Pointing alias %s at version %s ...",
+                    upldr_config.alias, version)
+        alias_method = client.update_alias if exists else client.create_alias
+        alias_method(
+            FunctionName=upldr_config.name,
+            Name=upldr_config.alias,
+            FunctionVersion=version,
+            Description=upldr_config.alias_description,
+        )
+
+    def lambda_code(self, pkg, code_sha256):
+        staging = self.config['stages'][self.stage].get('s3Staging')
+        if not staging:
+            with open(pkg.zip_file, 'rb') as fh:
+                zip_file = fh.read()
+            trace.annotate(bytes=len(zip_file))
+            return {'ZipFile': zip_file}
+        return self.stage_lambda_code(pkg, code_sha256, staging)
+
+    def stage_lambda_code(self, pkg, code_sha256, staging):
+        # Keys are content addressed, so an artifact that is already in the
+        # bucket never has to be uploaded again.
+        s3 = aws.get_client('s3', self.region)
+        bucket = staging['bucket'].format(region=self.region)
+        key = '{}{}/{}.zip'.format(
+            staging.get('prefix', ''),
+            self.config['Lambda']['config']['name'],
+            binascii.hexlify(base64.b64decode(code_sha256)).decode('utf-8'))
         try:
-            aws_account_id = boto3.client('iam').get_user()[
-                'User']['Arn'].split(':')[4]
-        except ClientError:
-            aws_account_id = boto3.client('sts').get_caller_identity()[
-                'Account']
-        try:
-            assert aws_account_id == self.account_id
-        except Exception:
-            LOG.error('yoke.yml accountId (%s) does not match credentials'
-                      'account (%s)!', self.account_id, aws_account_id)
-            raise
+            s3.head_object(Bucket=bucket, Key=key)
+            LOG.warning("Package already staged at s3://%s/%s", bucket, key)
+            trace.annotate(cache_hits=1)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] not in ('404', 'NoSuchKey',
+                                                     'NotFound'):
+                raise
+            part_size = int(staging.get('partSize', S3_PART_SIZE_MB)) * MB
+            LOG.warning("Staging package at s3://%s/%s ...", bucket, key)
+            s3.upload_file(
+                pkg.zip_file, bucket, key,
+                Config=TransferConfig(
+                    multipart_threshold=part_size,
+                    multipart_chunksize=part_size,
+                    max_concurrency=int(staging.get('concurrency',
+                                                    S3_CONCURRENCY)),
+                ),
+            )
+            trace.annotate(bytes=os.path.getsize(pkg.zip_file))
+        return {'S3Bucket': bucket, 'S3Key': key}
 
     def write_lambda_config(self):
         lambda_config = self.config['stages'][self.stage].get('config')
@@ -335,6 +1083,11 @@ class Deployment(object):
             with open(config_file, 'w') as outfile:
                 json.dump(lambda_config, outfile)
 
+    @trace.traced('deploy.write_lambda_files')
+    def write_lambda_files(self):
+        self.write_lambda_json()
+        self.write_lambda_config()
+
     def write_lambda_json(self):
         lambda_json = os.path.join(self.lambda_path,
                                    'lambda.json')
@@ -349,22 +1102,25 @@ class Deployment(object):
         with open(swagger_file, 'w') as fh:
             # Could be `.yaml` or `.yml` :/
             if '.y' in ext:
-                fh.write(yaml.round_trip_dump(output))
+                utils.dump_yaml(output, fh)
             elif '.json' in ext:
-                fh.write(json.dumps(output))
+                json.dump(output, fh)
+        return swagger_file
+
+    @trace.traced('deploy.write_swagger')
+    def write_swagger(self, template, deref):
+        name = 'swagger'
+        if self.multi_region:
+            name = 'swagger.{}'.format(self.region)
+        swagger_file = self.write_template(template,
+                                           filename='{}.yml'.format(name))
+        # Also write the deref'd JSON version, because we might want this.
+        self.write_template(deref, filename='{}.json'.format(name))
         return swagger_file
 
+    @trace.traced('deploy.deref')
     def deref(self, data):
         """AWS doesn't quite have Swagger 2.0 validation right and will fail
         on some refs. So, we need to convert to deref before
         upload."""
-
-        # We have to make a deepcopy here to create a proper JSON
-        # compatible object, otherwise `json.dumps` fails when it
-        # hits jsonref.JsonRef objects.
-        deref = copy.deepcopy(jsonref.JsonRef.replace_refs(data))
-
-        # Write out JSON version because we might want this.
-        self.write_template(deref, filename='swagger.json')
-
-        return deref
+        return refs.deref(data)
@@ -0,0 +1,227 @@
+"""Import time of a Lambda handler, measured inside its built package.
+
+The package is unpacked into a scratch directory and the handler module is
+imported from there the way the Lambda runtime does it, under
+`python -X importtime`. Modules are attributed to the distributions
+installed in the package's extra directories (see `sizes`).
+"""
+
+from collections import defaultdict, OrderedDict
+import logging
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from . import sizes
+from . import trace
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_RUNS = 3
+DEFAULT_MIN_MS = 1.0
+OUTSIDE_PACKAGE = '(outside the package)'
+
+MARKER = 'yoke: importing handler'
+IMPORT_LINE = re.compile(r'^import time:\s*(\d+) \|\s*(\d+) \| ( *)(\S+)\s*$')
+# `importlib.import_module()` would bypass -X importtime, `__import__()`
+# doesn't.
+IMPORT_SCRIPT = '''
+import sys
+sys.path.insert(0, sys.argv[1])
+name = sys.argv[2]
+sys.stderr.write({marker!r} + '\\n')
+sys.stderr.flush()
+__import__(name)
+getattr(sys.modules[name], sys.argv[3])
+'''.format(marker=MARKER)
+
+
+class Module(object):
+
+    def __init__(self, name, self_us, cumulative_us, children):
+        self.name = name
+        self.self_us = self_us
+        self.cumulative_us = cumulative_us
+        self.children = children
+
+    def walk(self, depth=0):
+        yield depth, self
+        for child in sorted(self.children,
+                            key=lambda child: -child.cumulative_us):
+            for item in child.walk(depth + 1):
+                yield item
+
+
+def parse_importtime(output):
+    """Top-level `Module`s imported after the marker line."""
+    lines = output.splitlines()
+    if MARKER in lines:
+        lines = lines[lines.index(MARKER) + 1:]
+    # Modules are reported once they are done, i.e. after everything they
+    # import, one level deeper.
+    pending = defaultdict(list)
+    for line in lines:
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        level = len(indent) // 2
+        pending[level].append(Module(name, int(self_us), int(cumulative_us),
+                                     pending.pop(level + 1, [])))
+    return pending[0]
+
+
+def split_handler(handler):
+    """Module name and function of a `path/to/module.function` handler, the
+    way the Lambda runtime imports it."""
+    module, function = handler.rsplit('.', 1)
+    return module.replace('/', '.'), function
+
+
+def import_handler(task_root, handler, python):
+    module, function = split_handler(handler)
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    env['LAMBDA_TASK_ROOT'] = task_root
+    process = subprocess.Popen(
+        [python, '-s', '-X', 'importtime', '-c', IMPORT_SCRIPT, task_root,
+         module, function],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+        cwd=task_root)
+    _, err = process.communicate()
+    err = err.decode('utf-8', 'replace')
+    if process.returncode != 0:
+        raise Exception("Importing {} failed:\n{}".format(
+            handler, '\n'.join(line for line in err.splitlines()
+                               if not line.startswith('import time:'))))
+    modules = parse_importtime(err)
+    if not modules:
+        raise Exception("{} didn't report import times, -X importtime needs "
+                        "Python 3.7 or later.".format(python))
+    return modules
+
+
+@trace.traced('imports.profile')
+def profile_package(zip_file, handler, python=None, runs=DEFAULT_RUNS):
+    """Import the handler `runs` times and return the modules of the fastest
+    run."""
+    task_root = tempfile.mkdtemp(prefix='yoke-imports-')
+    try:
+        with zipfile.ZipFile(zip_file) as archive:
+            archive.extractall(task_root)
+        best = None
+        for _ in range(max(1, runs)):
+            modules = import_handler(task_root, handler,
+                                     python or sys.executable)
+            total = sum(module.cumulative_us for module in modules)
+            if best is None or total < best[0]:
+                best = (total, modules)
+        return best[1]
+    finally:
+        shutil.rmtree(task_root, ignore_errors=True)
+
+
+def module_owners(lambda_path, extra_files):
+    """Map module names (and their packages, two levels deep) to the
+    distribution or code providing them."""
+    owners = {}
+    for extra in extra_files or []:
+        # Modules are imported relative to the extra directory, which is in
+        # the package under its own name unless given with a trailing slash.
+        prefix = os.path.basename(extra) or '.'
+        for dist in sizes.find_distributions([extra]).values():
+            for arcname in dist.files:
+                add_owner(owners, posixpath.relpath(arcname, prefix),
+                          dist.name)
+    for entry in os.listdir(lambda_path):
+        name = entry.split('.')[0]
+        if name and name not in owners:
+            owners[name] = sizes.FUNCTION_CODE
+    return owners
+
+
+def add_owner(owners, relpath, dist_name):
+    parts = relpath.split('/')
+    if len(parts) > 1 and parts[0].endswith(('.dist-info', '.egg-info')):
+        return
+    parts[-1] = parts[-1].split('.')[0]
+    for depth in range(1, min(len(parts), 2) + 1):
+        name = '.'.join(parts[:depth])
+        # Namespace packages can be shared by several distributions.
+        if owners.setdefault(name, dist_name) != dist_name:
+            owners[name] = None
+
+
+def owner(name, owners):
+    parts = name.split('.')
+    for depth in (2, 1):
+        if owners.get('.'.join(parts[:depth])):
+            return owners['.'.join(parts[:depth])]
+    return OUTSIDE_PACKAGE
+
+
+def summarize(modules, owners):
+    """The profile as a dict ready to be dumped as JSON. Times are in
+    microseconds."""
+    module_times = OrderedDict()
+    distributions = defaultdict(int)
+    for root in modules:
+        for _, module in root.walk():
+            module_times[module.name] = [module.self_us,
+                                         module.cumulative_us]
+            distributions[owner(module.name, owners)] += module.self_us
+    return {
+        'total': sum(module.cumulative_us for module in modules),
+        'modules': module_times,
+        'distributions': dict(distributions),
+    }
+
+
+def format_ms(us):
+    return '{:.1f}ms'.format(us / 1000.0)
+
+
+def format_delta(us, previous_us):
+    if previous_us is None:
+        return 'new'
+    return '{:+.1f}ms'.format((us - previous_us) / 1000.0)
+
+
+def format_report(modules, summary, previous=None, min_ms=DEFAULT_MIN_MS):
+    previous = previous or {}
+    previous_modules = previous.get('modules', {})
+    previous_dists = previous.get('distributions', {})
+
+    def delta(us, old):
+        return format_delta(us, old) if previous else ''
+
+    lines = ['Handler imported in {}{}'.format(
+        format_ms(summary['total']),
+        ' ({} since the previous build)'.format(
+            format_delta(summary['total'], previous['total']))
+        if previous else '')]
+
+    line = '{:<48} {:>10} {:>10} {:>10}'
+    lines.extend(['', line.format('module', 'cumulative', 'self', 'change')])
+    for root in sorted(modules, key=lambda module: -module.cumulative_us):
+        for depth, module in root.walk():
+            if module.cumulative_us < min_ms * 1000:
+                continue
+            old = previous_modules.get(module.name)
+            lines.append(line.format(
+                '  ' * depth + module.name, format_ms(module.cumulative_us),
+                format_ms(module.self_us),
+                delta(module.cumulative_us, old and old[1])))
+
+    line = '{:<48} {:>10} {:>10}'
+    lines.extend(['', line.format('distribution', 'self', 'change')])
+    for name, self_us in sorted(summary['distributions'].items(),
+                                key=lambda item: -item[1]):
+        lines.append(line.format(name, format_ms(self_us),
+                                 delta(self_us, previous_dists.get(name))))
+    return '\n'.join(lines)
@@ -0,0 +1,314 @@
+"""Optional clean-up of the Lambda package, to make it smaller and quicker to
+cold start: stale bytecode, tests, docs and install metadata are pruned,
+bytecode is compiled ahead of time and shared objects lose their debug
+symbols.
+
+Everything works on the `(arcname, path)` entries of `packager`, so the
+source files are never modified. Compiled and stripped files are written to
+a work directory (in the yoke cache when it is enabled, so they are only
+redone when their source changes).
+"""
+
+import calendar
+from hashlib import sha256
+import logging
+import marshal
+import multiprocessing
+import os
+import posixpath
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+from .import_profile import split_handler
+from . import trace
+
+try:
+    from shutil import which
+except ImportError:  # Python 2
+    from distutils.spawn import find_executable as which
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:  # Python 2
+    from imp import get_magic
+    MAGIC_NUMBER = get_magic()
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_OPTIONS = {
+    'bytecode': True,
+    'strip': True,
+    'prune': True,
+    'keep': [],
+    'importTime': True,
+}
+
+# Matched against archive names. Anything matching a `keep` pattern stays.
+PRUNE_PATTERNS = [
+    r'(^|/)__pycache__/',
+    r'\.py[co]$',
+    r'\.pyi$',
+    # importlib.metadata / pkg_resources only need these to find versions
+    # and entry points.
+    r'\.(dist|egg)-info/(?!(METADATA|PKG-INFO|entry_points\.txt)$)',
+]
+# Only pruned when they aren't packages, e.g. botocore.docs is imported by
+# botocore.client.
+PRUNE_DIRECTORIES = re.compile(r'(^|/)((tests?|docs?)/)')
+SHARED_OBJECT = re.compile(r'\.so(\.\d+)*$')
+RUNTIME_VERSION = re.compile(r'^python(\d+)\.(\d+)')
+
+# Lambda extracts the package with the timestamp packager gives every member.
+ZIP_MTIME = calendar.timegm((1980, 1, 1, 0, 0, 0, 0, 1, 0))
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.time()
+__import__(sys.argv[2])
+sys.stdout.write(repr(time.time() - started))
+'''
+
+
+def get_options(lambda_config):
+    """Options of the `optimize` section, or None if it's disabled. `true`
+    enables every step."""
+    value = lambda_config.get('optimize')
+    if not value:
+        return None
+    options = dict(DEFAULT_OPTIONS)
+    if isinstance(value, dict):
+        options.update(value)
+    return options
+
+
+def entries_size(entries):
+    return sum(os.path.getsize(path) for _, path in entries)
+
+
+def format_size(size):
+    return '{:.1f}MB'.format(size / (1024.0 * 1024))
+
+
+def file_sha256(path):
+    digest = sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def runtime_matches(runtime):
+    match = RUNTIME_VERSION.match(runtime or '')
+    return (match is not None and
+            tuple(int(part) for part in match.groups()) ==
+            tuple(sys.version_info[:2]))
+
+
+def bytecode_name(arcname):
+    if sys.version_info[0] == 2:
+        return arcname + 'c'
+    directory, filename = posixpath.split(arcname)
+    return posixpath.join(directory, '__pycache__', '{}.{}.pyc'.format(
+        filename[:-3], sys.implementation.cache_tag))
+
+
+def compile_bytecode(source, arcname):
+    code = compile(source, arcname, 'exec', dont_inherit=True)
+    if sys.version_info >= (3, 7):
+        # Unchecked hash-based pyc (PEP 552): used without looking at the
+        # source's timestamp, which Lambda doesn't guarantee.
+        from importlib.util import source_hash
+        header = MAGIC_NUMBER + struct.pack('<I', 0b01) + source_hash(source)
+    elif sys.version_info[0] == 3:
+        header = MAGIC_NUMBER + struct.pack('<II', ZIP_MTIME,
+                                            len(source) & 0xFFFFFFFF)
+    else:
+        header = MAGIC_NUMBER + struct.pack('<I', ZIP_MTIME)
+    return header + marshal.dumps(code)
+
+
+class Optimizer(object):
+    """Rewrites the entries of a Lambda package according to `options` (see
+    `DEFAULT_OPTIONS`)."""
+
+    def __init__(self, options, runtime, handler, work_dir=None):
+        self.options = options
+        self.runtime = runtime
+        self.handler = handler
+        self.keep = [re.compile(pattern) for pattern in options['keep']]
+        self.prune_patterns = [re.compile(pattern)
+                               for pattern in PRUNE_PATTERNS]
+        self.temporary = work_dir is None
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix='yoke-optimize-')
+        self.used = set()
+        self.before = None
+        self.after = None
+
+    def close(self):
+        if self.temporary:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            return
+        # Drop whatever the previous build produced and this one didn't.
+        for name in os.listdir(self.work_dir):
+            if name not in self.used:
+                os.remove(os.path.join(self.work_dir, name))
+
+    def work_file(self, key, suffix):
+        name = cache.fingerprint(*key) + suffix
+        self.used.add(name)
+        return os.path.join(self.work_dir, name)
+
+    @trace.traced('optimize.entries')
+    def optimize(self, entries):
+        self.before = (len(entries), entries_size(entries))
+        if self.options['prune']:
+            entries = self.prune(entries)
+        if self.options['strip']:
+            entries = self.strip(entries)
+        if self.options['bytecode']:
+            entries = self.compile(entries)
+        self.after = (len(entries), entries_size(entries))
+        trace.annotate(files_removed=self.before[0] - self.after[0],
+                       bytes_removed=self.before[1] - self.after[1])
+        return entries
+
+    def kept(self, arcname):
+        return any(pattern.search(arcname) for pattern in self.keep)
+
+    def prune(self, entries):
+        arcnames = set(arcname for arcname, _ in entries)
+
+        def pruned_directory(arcname):
+            for match in PRUNE_DIRECTORIES.finditer(arcname):
+                directory = arcname[:match.end()]
+                if directory + '__init__.py' not in arcnames:
+                    return True
+            return False
+
+        return [(arcname, path) for arcname, path in entries
+                if self.kept(arcname) or
+                not (pruned_directory(arcname) or
+                     any(pattern.search(arcname)
+                         for pattern in self.prune_patterns))]
+
+    def strip(self, entries):
+        strip = which('strip')
+        if strip is None:
+            LOG.warning("Not stripping shared objects: `strip` not found.")
+            return entries
+
+        def strip_entry(entry):
+            arcname, path = entry
+            if not SHARED_OBJECT.search(arcname) or self.kept(arcname):
+                return entry
+            target = self.work_file(('strip', file_sha256(path)), '.so')
+            if os.path.isfile(target):
+                return arcname, target
+            # Write next to the target first, so an interrupted strip never
+            # leaves a broken file in the cache.
+            partial = target + '.tmp'
+            try:
+                subprocess.check_output([strip, '--strip-debug', '-o',
+                                         partial, path],
+                                        stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as exc:
+                # Not an object file for this platform's strip, e.g. ELF
+                # objects on macOS.
+                LOG.debug("Could not strip %s: %s", arcname, exc.output)
+                if os.path.exists(partial):
+                    os.remove(partial)
+                return entry
+            os.rename(partial, target)
+            return arcname, target
+
+        workers = multiprocessing.cpu_count()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(strip_entry, entries))
+
+    def compile(self, entries):
+        if not runtime_matches(self.runtime):
+            LOG.warning("Not compiling bytecode: the %s runtime needs the "
+                        "same Python version, this is Python %s.%s.",
+                        self.runtime, *sys.version_info[:2])
+            return entries
+
+        compiled = []
+        for arcname, path in entries:
+            if not arcname.endswith('.py'):
+                continue
+            with open(path, 'rb') as fh:
+                source = fh.read()
+            target = self.work_file(
+                ('bytecode', MAGIC_NUMBER, arcname,
+                 sha256(source).hexdigest()), '.pyc')
+            if not os.path.isfile(target):
+                try:
+                    bytecode = compile_bytecode(source, arcname)
+                except (SyntaxError, ValueError) as exc:
+                    # Files for another Python version, templates, ...
+                    LOG.debug("Not compiling %s: %s", arcname, exc)
+                    continue
+                cache.write_bytes(target, bytecode)
+            else:
+                trace.annotate(cache_hits=1)
+            compiled.append((bytecode_name(arcname), target))
+
+        replaced = set(arcname for arcname, _ in compiled)
+        entries = [entry for entry in entries if entry[0] not in replaced]
+        return sorted(entries + compiled)
+
+    @trace.traced('optimize.import_time')
+    def import_time(self, zip_file):
+        """Seconds it takes to import the handler module from the package,
+        with the local interpreter. Raises an exception if it can't be
+        imported."""
+        module, _ = split_handler(self.handler)
+        extract_dir = tempfile.mkdtemp(prefix='yoke-import-')
+        try:
+            with zipfile.ZipFile(zip_file) as archive:
+                archive.extractall(extract_dir)
+            env = dict(os.environ)
+            env.pop('PYTHONPATH', None)
+            process = subprocess.Popen(
+                [sys.executable, '-c', IMPORT_SCRIPT, extract_dir, module],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                cwd=extract_dir)
+            out, err = process.communicate()
+            if process.returncode != 0:
+                raise Exception(
+                    "Could not import {} from the optimized package:\n"
+                    "{}".format(module,
+                                err.decode('utf-8', 'replace').strip()))
+            return float(out)
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+
+    def report(self, zip_file):
+        LOG.warning("Optimized package: %s files, %s -> %s files, %s "
+                    "(%s compressed).", self.before[0],
+                    format_size(self.before[1]), self.after[0],
+                    format_size(self.after[1]),
+                    format_size(os.path.getsize(zip_file)))
+        if self.options['importTime'] and self.handler:
+            try:
+                seconds = self.import_time(zip_file)
+            except Exception as exc:
+                # Only a failure with the runtime's Python version means the
+                # package is broken, e.g. by pruning something it imports.
+                if runtime_matches(self.runtime):
+                    raise Exception("{}\nAdd what's missing to the `keep` "
+                                    "patterns of Lambda.optimize.".format(exc))
+                LOG.warning("%s\nThe %s runtime isn't this Python version, "
+                            "ignoring.", exc, self.runtime)
+                return
+            LOG.warning("Handler module imported locally in %.1fms.",
+                        seconds * 1000)
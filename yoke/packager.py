@@ -0,0 +1,394 @@
+from collections import deque
+from hashlib import sha256
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import stat
+import struct
+from tempfile import SpooledTemporaryFile
+import zipfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+from . import trace
+
+LOG = logging.getLogger(__name__)
+
+ZIPFILE_NAME = 'lambda_function.zip'
+# Left behind by older versions of yoke, which packaged through
+# lambda-uploader's workspace.
+TEMP_WORKSPACE_NAME = '.lambda_uploader_temp'
+CHUNK_SIZE = 1024 * 1024
+# Compressed members are kept in memory up to this size, and spill over to a
+# temporary file beyond it.
+SPOOL_SIZE = 4 * 1024 * 1024
+
+# Every member gets the same timestamp (the earliest one zip can represent)
+# and one of two permission sets, so identical sources produce identical
+# archives.
+DOS_DATE = (1 << 5) | 1  # 1980-01-01
+DOS_TIME = 0
+FILE_MODE = 0o100644
+EXEC_MODE = 0o100755
+COMPRESS_LEVEL = 6
+# Members have to shrink to at least this fraction of their size to be
+# stored deflated rather than as-is.
+MIN_COMPRESSION_RATIO = 0.95
+# Formats that are already compressed, deflate won't do anything for them.
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.7z', '.bz2', '.egg', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.mp3',
+    '.mp4', '.png', '.tgz', '.webp', '.whl', '.woff', '.woff2', '.xz',
+    '.zip',
+])
+CREATE_SYSTEM_UNIX = 3
+VERSION = 20
+ZIP64_VERSION = 45
+FLAG_UTF8 = 0x800
+# Counts, sizes and offsets from these on are only stored in ZIP64 records,
+# the regular fields hold these values instead.
+ZIP_MAX_ENTRIES = 0xFFFF
+ZIP_MAX_OFFSET = 0xFFFFFFFF
+ZIP64_EXTRA_ID = 0x0001
+
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+END_OF_CENTRAL_DIR = struct.Struct('<4s4H2LH')
+ZIP64_END_OF_CENTRAL_DIR = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+
+
+class ZipMember(object):
+    """A member ready to be written: its metadata plus a `writer` callable
+    that copies its (compressed) data to a file object."""
+
+    def __init__(self, arcname, mode, sha, crc, compress_type, file_size,
+                 compress_size, writer):
+        self.arcname = arcname
+        self.mode = mode
+        self.sha = sha
+        self.crc = crc
+        self.compress_type = compress_type
+        self.file_size = file_size
+        self.compress_size = compress_size
+        self.writer = writer
+
+
+class LambdaPackage(object):
+
+    def __init__(self, path, zipfile_name=ZIPFILE_NAME):
+        self.zip_file = os.path.join(path, zipfile_name)
+
+    def clean_zipfile(self):
+        if os.path.isfile(self.zip_file):
+            os.remove(self.zip_file)
+
+
+def ignore_file(path, ignore):
+    for pattern in ignore:
+        if re.search(pattern, path):
+            return True
+    return False
+
+
+def walk_dir(src, prefix='', ignore=None, exclude=None):
+    entries = []
+    ignore = ignore or []
+    exclude = exclude or []
+    abs_src = os.path.abspath(src)
+    for root, dirs, files in os.walk(abs_src):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) not in exclude]
+        for filename in files:
+            path = os.path.join(root, filename)
+            relpath = os.path.relpath(path, abs_src)
+            if path in exclude or ignore_file(relpath, ignore):
+                continue
+            arcname = os.path.join(prefix, relpath).replace(os.sep, '/')
+            entries.append((arcname, path))
+    return entries
+
+
+def collect_entries(lambda_path, extra_files=None, ignore=None,
+                    exclude=None):
+    """Map archive names to the source files that go into the package.
+
+    Follows the layout lambda-uploader used to build in its workspace: the
+    contents of `lambda_path` at the root, extra directories under their own
+    name (or at the root when given with a trailing slash, like `./lib/`)
+    and extra files at the root. Later sources win.
+    """
+    ignore = list(ignore or [])
+    ignore.append(r"^%s/.*" % re.escape(TEMP_WORKSPACE_NAME))
+    exclude = [os.path.abspath(path) for path in exclude or []]
+    mapping = dict(walk_dir(lambda_path, ignore=ignore, exclude=exclude))
+    for extra in extra_files or []:
+        if os.path.isdir(extra):
+            mapping.update(walk_dir(extra, os.path.basename(extra),
+                                    ignore=ignore, exclude=exclude))
+        else:
+            mapping[os.path.basename(extra)] = extra
+    return sorted(mapping.items())
+
+
+def encode_name(arcname):
+    try:
+        return arcname.encode('ascii'), 0
+    except UnicodeError:
+        return arcname.encode('utf-8'), FLAG_UTF8
+
+
+def file_mode(path):
+    if os.stat(path).st_mode & stat.S_IXUSR:
+        return EXEC_MODE
+    return FILE_MODE
+
+
+def read_chunks(path):
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def hash_file(path):
+    digest = sha256()
+    crc = 0
+    size = 0
+    for chunk in read_chunks(path):
+        digest.update(chunk)
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+    return digest.hexdigest(), crc & 0xFFFFFFFF, size
+
+
+def is_incompressible(arcname):
+    return os.path.splitext(arcname)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+
+def copy_file(path):
+    def writer(fh):
+        with open(path, 'rb') as src:
+            shutil.copyfileobj(src, fh, CHUNK_SIZE)
+    return writer
+
+
+def copy_spool(spool):
+    def writer(fh):
+        spool.seek(0)
+        shutil.copyfileobj(spool, fh, CHUNK_SIZE)
+        spool.close()
+    return writer
+
+
+def copy_raw_member(previous, info):
+    # Copy the member's compressed bytes exactly as they are stored.
+    def writer(fh):
+        src = previous.fp
+        src.seek(info.header_offset)
+        header = src.read(LOCAL_HEADER.size)
+        name_length, extra_length = struct.unpack('<2H', header[26:30])
+        src.seek(info.header_offset + LOCAL_HEADER.size + name_length +
+                 extra_length)
+        remaining = info.compress_size
+        while remaining:
+            chunk = src.read(min(CHUNK_SIZE, remaining))
+            fh.write(chunk)
+            remaining -= len(chunk)
+    return writer
+
+
+def compress_member(arcname, path, sha, crc, size, level):
+    mode = file_mode(path)
+    if level and not is_incompressible(arcname):
+        spool = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for chunk in read_chunks(path):
+            spool.write(compressor.compress(chunk))
+        spool.write(compressor.flush())
+        compress_size = spool.tell()
+        # Not worth making Lambda inflate it for a handful of bytes.
+        if compress_size < size * MIN_COMPRESSION_RATIO:
+            return ZipMember(arcname, mode, sha, crc, zipfile.ZIP_DEFLATED,
+                             size, compress_size, copy_spool(spool))
+        spool.close()
+    return ZipMember(arcname, mode, sha, crc, zipfile.ZIP_STORED, size, size,
+                     copy_file(path))
+
+
+def zip64_extra(values):
+    if not values:
+        return b''
+    return struct.pack('<2H{}Q'.format(len(values)), ZIP64_EXTRA_ID,
+                       8 * len(values), *values)
+
+
+def write_zip(fh, members):
+    """Write `members` as a zip archive to `fh`, which only needs a
+    `write()` method, and return the number of bytes written. ZIP64 records
+    are only added when a package needs them."""
+    central_dir = []
+    offset = 0
+    for member in members:
+        name, flags = encode_name(member.arcname)
+        file_size, compress_size = member.file_size, member.compress_size
+        # The local header needs both sizes in its ZIP64 field, the central
+        # directory only the ones that don't fit.
+        if max(file_size, compress_size) >= ZIP_MAX_OFFSET:
+            local_extra = zip64_extra([file_size, compress_size])
+            file_size = compress_size = ZIP_MAX_OFFSET
+        else:
+            local_extra = b''
+        header = LOCAL_HEADER.pack(
+            b'PK\x03\x04', ZIP64_VERSION if local_extra else VERSION, 0,
+            flags, member.compress_type, DOS_TIME, DOS_DATE, member.crc,
+            compress_size, file_size, len(name), len(local_extra))
+        fh.write(header)
+        fh.write(name)
+        fh.write(local_extra)
+        member.writer(fh)
+
+        zip64_values = [value for value in (member.file_size,
+                                            member.compress_size, offset)
+                        if value >= ZIP_MAX_OFFSET]
+        extra = zip64_extra(zip64_values)
+        version = ZIP64_VERSION if extra else VERSION
+        central_dir.append(CENTRAL_HEADER.pack(
+            b'PK\x01\x02', version, CREATE_SYSTEM_UNIX, version, 0, flags,
+            member.compress_type, DOS_TIME, DOS_DATE, member.crc,
+            compress_size, file_size, len(name), len(extra), 0, 0, 0,
+            member.mode << 16, min(offset, ZIP_MAX_OFFSET)) + name + extra)
+        offset += (len(header) + len(name) + len(local_extra) +
+                   member.compress_size)
+
+    count = len(central_dir)
+    central_dir = b''.join(central_dir)
+    fh.write(central_dir)
+    size = offset + len(central_dir)
+    if (count >= ZIP_MAX_ENTRIES or offset >= ZIP_MAX_OFFSET or
+            len(central_dir) >= ZIP_MAX_OFFSET):
+        fh.write(ZIP64_END_OF_CENTRAL_DIR.pack(
+            b'PK\x06\x06', ZIP64_END_OF_CENTRAL_DIR.size - 12, ZIP64_VERSION,
+            ZIP64_VERSION, 0, 0, count, count, len(central_dir), offset))
+        fh.write(ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, size, 1))
+        size += ZIP64_END_OF_CENTRAL_DIR.size + ZIP64_LOCATOR.size
+    fh.write(END_OF_CENTRAL_DIR.pack(
+        b'PK\x05\x06', 0, 0, min(count, ZIP_MAX_ENTRIES),
+        min(count, ZIP_MAX_ENTRIES), min(len(central_dir), ZIP_MAX_OFFSET),
+        min(offset, ZIP_MAX_OFFSET), 0))
+    return size + END_OF_CENTRAL_DIR.size
+
+
+class ZipBuilder(object):
+    """Builds byte-reproducible Lambda packages straight from the source
+    files, without copying them anywhere first.
+
+    Members are hashed and compressed on a thread pool, with a bounded
+    number of them in flight, so memory use doesn't grow with the size of
+    the package. A copy of the last package built is kept in the yoke cache
+    together with the SHA-256 of each member, so members whose content
+    hasn't changed are copied over without compressing them again.
+    """
+
+    def __init__(self, zip_file, cache_dir=None, level=COMPRESS_LEVEL,
+                 workers=None):
+        self.zip_file = zip_file
+        self.level = level
+        self.workers = workers or multiprocessing.cpu_count()
+        self.cache_zip = None
+        self.cache_manifest = None
+        self.members = []
+        self.reused = 0
+        if cache_dir:
+            key = cache.fingerprint(os.path.abspath(zip_file))[:16]
+            self.cache_zip = os.path.join(cache_dir, key + '.zip')
+            self.cache_manifest = os.path.join(cache_dir, key + '.json')
+
+    def previous_members(self):
+        if not self.cache_manifest:
+            return None, {}
+        manifest = cache.read_json(self.cache_manifest)
+        if (not manifest or manifest.get('level') != self.level or
+                not os.path.isfile(self.cache_zip)):
+            return None, {}
+        try:
+            previous = zipfile.ZipFile(self.cache_zip)
+        except zipfile.BadZipfile:
+            return None, {}
+        by_sha = {}
+        for info in previous.infolist():
+            sha = manifest['members'].get(info.filename)
+            if sha:
+                by_sha[sha] = info
+        return previous, by_sha
+
+    def prepare_member(self, entry, previous, by_sha):
+        # Runs on the worker pool: zlib and hashlib release the GIL, so
+        # hashing and compressing members scales across cores.
+        arcname, path = entry
+        sha, crc, size = hash_file(path)
+        info = by_sha.get(sha)
+        if info is not None:
+            return ZipMember(arcname, file_mode(path), sha, info.CRC,
+                             info.compress_type, info.file_size,
+                             info.compress_size,
+                             copy_raw_member(previous, info))
+        return compress_member(arcname, path, sha, crc, size, self.level)
+
+    def prepared_members(self, executor, entries, previous, by_sha):
+        pending = deque()
+        for entry in entries:
+            pending.append(executor.submit(self.prepare_member, entry,
+                                           previous, by_sha))
+            if len(pending) >= self.workers * 2:
+                yield self.track(pending.popleft().result(), by_sha)
+        while pending:
+            yield self.track(pending.popleft().result(), by_sha)
+
+    def track(self, member, by_sha):
+        self.members.append((member.arcname, member.sha))
+        if member.sha in by_sha:
+            self.reused += 1
+        return member
+
+    def write(self, fh, entries):
+        """Write the package for `entries`, a list of (archive name, source
+        path) pairs, to the file object `fh`. `fh` doesn't have to be
+        seekable."""
+        self.members = []
+        self.reused = 0
+        previous, by_sha = self.previous_members()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                size = write_zip(fh, self.prepared_members(
+                    executor, sorted(entries), previous, by_sha))
+        finally:
+            if previous is not None:
+                previous.close()
+        LOG.warning("Packaged %d files (%d unchanged)", len(self.members),
+                    self.reused)
+        trace.annotate(files=len(self.members), cache_hits=self.reused,
+                       bytes=size)
+
+    def build(self, entries):
+        target = self.cache_zip or self.zip_file
+        tmp_path = target + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            self.write(fh, entries)
+        if self.cache_manifest and os.path.exists(self.cache_manifest):
+            # Never leave a manifest around that describes another zip.
+            os.remove(self.cache_manifest)
+        os.rename(tmp_path, target)
+        if self.cache_zip:
+            cache.write_json(self.cache_manifest, {
+                'level': self.level,
+                'members': dict(self.members),
+            })
+            if os.path.exists(self.zip_file):
+                os.remove(self.zip_file)
+            try:
+                os.link(self.cache_zip, self.zip_file)
+            except OSError:
+                shutil.copyfile(self.cache_zip, self.zip_file)
+        return self.zip_file
@@ -0,0 +1,101 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+class Task(object):
+
+    def __init__(self, name, func, deps):
+        self.name = name
+        self.func = func
+        self.deps = deps
+        self.result = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class Pipeline(object):
+    """A small graph of tasks run on a thread pool.
+
+    A task is started as soon as all of its dependencies have finished, and
+    can get their return values from `result()`. The first failing task stops
+    the pipeline: tasks that haven't started yet are skipped and the
+    exception is raised from `run()`.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or DEFAULT_WORKERS
+        self.tasks = []
+        self._tasks = {}
+        self.started = None
+
+    def add(self, name, func, deps=()):
+        for dep in deps:
+            if dep not in self._tasks:
+                raise Exception("Unknown dependency {} for task {}".format(
+                    dep, name))
+        task = Task(name, func, list(deps))
+        self.tasks.append(task)
+        self._tasks[name] = task
+        return task
+
+    def __contains__(self, name):
+        return name in self._tasks
+
+    def result(self, name):
+        return self._tasks[name].result
+
+    def _run_task(self, task):
+        task.started = time.time()
+        try:
+            task.result = task.func()
+        finally:
+            task.finished = time.time()
+        return task
+
+    def run(self):
+        self.started = time.time()
+        done = set()
+        pending = list(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                # Tasks were added in dependency order, so keeping that order
+                # here makes a single worker run them exactly like the old
+                # sequential code did.
+                for task in list(pending):
+                    if all(dep in done for dep in task.deps):
+                        pending.remove(task)
+                        running[executor.submit(self._run_task, task)] = task
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task = running.pop(future)
+                    if future.exception() is not None:
+                        for other in running:
+                            other.cancel()
+                        raise future.exception()
+                    done.add(task.name)
+
+    def format_timings(self):
+        width = max([len('task')] + [len(task.name) for task in self.tasks])
+        line = '{:<%d} {:>8} {:>8}  {}' % width
+        lines = [line.format('task', 'start', 'time', 'depends on')]
+        for task in self.tasks:
+            if task.started is None:
+                start = duration = '-'
+            else:
+                start = '{:.2f}s'.format(task.started - self.started)
+                duration = '{:.2f}s'.format(task.duration)
+            lines.append(line.format(task.name, start, duration,
+                                     ', '.join(task.deps)))
+        return '\n'.join(lines)
@@ -0,0 +1,104 @@
+"""Replace the `$ref`s of a Swagger document with what they point to.
+
+Every reference target is resolved once, and the result is shared by all
+the places referring to it: the returned document is plain dicts and lists
+(ready for `json.dump`), but must be treated as read-only.
+
+Only local references (`#/definitions/...`) are handled here. Documents
+referring to other files or URLs go through jsonref instead.
+"""
+
+import copy
+
+from six import string_types
+from six.moves.urllib.parse import unquote
+
+
+class NonLocalReference(Exception):
+    pass
+
+
+def unescape(part):
+    # JSON pointer escaping, see RFC 6901.
+    return unquote(part).replace('~1', '/').replace('~0', '~')
+
+
+def reference(node):
+    if isinstance(node, dict) and isinstance(node.get('$ref'), string_types):
+        return node['$ref']
+    return None
+
+
+class Dereferencer(object):
+
+    def __init__(self, document):
+        self.document = document
+        self.resolved = {}
+        # References being resolved, outermost first.
+        self.resolving = []
+
+    def lookup(self, ref):
+        """The raw node `ref` points to."""
+        if not ref.startswith('#'):
+            raise NonLocalReference(ref)
+        node = self.document
+        seen = set()
+        for part in [unescape(part) for part in ref[1:].split('/')[1:]]:
+            # The pointer can go through other references.
+            while reference(node) is not None:
+                if reference(node) in seen:
+                    raise Exception(
+                        "$ref {} can't be resolved, {} refers to "
+                        "itself".format(ref, reference(node)))
+                seen.add(reference(node))
+                node = self.lookup(reference(node))
+            try:
+                if isinstance(node, list):
+                    node = node[int(part)]
+                else:
+                    node = node[part]
+            except (KeyError, IndexError, TypeError, ValueError):
+                raise Exception("$ref {} can't be resolved, there is no "
+                                "{}".format(ref, part))
+        return node
+
+    def resolve(self, ref):
+        if ref in self.resolved:
+            return self.resolved[ref]
+        if ref in self.resolving:
+            cycle = self.resolving[self.resolving.index(ref):] + [ref]
+            raise Exception(
+                "Recursive $ref can't be dereferenced: {}. API Gateway "
+                "doesn't support recursive models.".format(
+                    ' -> '.join(cycle)))
+        self.resolving.append(ref)
+        try:
+            result = self.build(self.lookup(ref))
+        finally:
+            self.resolving.pop()
+        self.resolved[ref] = result
+        return result
+
+    def build(self, node):
+        ref = reference(node)
+        if ref is not None:
+            # Like jsonref, anything next to a `$ref` is ignored.
+            return self.resolve(ref)
+        if isinstance(node, dict):
+            return dict((key, self.build(value))
+                        for key, value in node.items())
+        if isinstance(node, list):
+            return [self.build(item) for item in node]
+        return node
+
+
+def deref(document):
+    """`document` with every `$ref` replaced by its target."""
+    try:
+        return Dereferencer(document).build(document)
+    except NonLocalReference:
+        # jsonref fetches files and URLs (relative to the current
+        # directory). Its lazy proxies have to be copied into plain objects
+        # before they can be serialized.
+        import jsonref
+        return copy.deepcopy(jsonref.JsonRef.replace_refs(document))
@@ -0,0 +1,100 @@
+import base64
+from hashlib import sha256
+import logging
+import os
+
+from . import cache
+
+LOG = logging.getLogger(__name__)
+
+
+class SecretCache(object):
+    """Local cache of KMS ciphertext -> plaintext.
+
+    Entries are encrypted at rest with a data key generated by the stage's
+    KMS key. Only the KMS-encrypted copy of the data key is stored, so a warm
+    cache costs a single KMS call per run instead of one per secret. Entries
+    older than `ttl` seconds are treated as missing.
+    """
+
+    def __init__(self, path, kms, key_name, ttl):
+        self.path = path
+        self.kms = kms
+        self.key_name = key_name
+        self.ttl = int(ttl)
+        self._fernet = None
+        self._dirty = False
+        self._data = cache.read_json(path) or {}
+        if self._data.get('keyName') != key_name:
+            self._data = {'keyName': key_name, 'entries': {}}
+
+    @classmethod
+    def for_stage(cls, config, kms):
+        stage = config['stages'][config['stage']]
+        ttl = stage.get('secretCacheTTL')
+        if not ttl or not cache.cache_enabled():
+            return None
+        # Only imported when the cache is used, it's slow to import.
+        try:
+            import cryptography.fernet  # noqa: F401
+        except ImportError:
+            LOG.warning("secretCacheTTL is set, but the `cryptography` "
+                        "package is not installed - not caching secrets.")
+            return None
+        path = os.path.join(
+            cache.cache_dir(config['project_dir'], 'secrets'),
+            '{}.json'.format(cache.fingerprint(config['stage'])[:16]))
+        return cls(path, kms, stage['keyName'], ttl)
+
+    @staticmethod
+    def blob_key(ciphertext_blob):
+        return sha256(ciphertext_blob).hexdigest()
+
+    def _get_fernet(self):
+        if self._fernet is None:
+            from cryptography.fernet import Fernet
+            if self._data.get('dataKey'):
+                resp = self.kms.decrypt(
+                    CiphertextBlob=base64.b64decode(self._data['dataKey']))
+            else:
+                resp = self.kms.generate_data_key(
+                    KeyId='alias/{}'.format(self.key_name),
+                    KeySpec='AES_256')
+                self._data['dataKey'] = base64.b64encode(
+                    resp['CiphertextBlob']).decode('utf-8')
+                self._data['entries'] = {}
+                self._dirty = True
+            self._fernet = Fernet(base64.urlsafe_b64encode(resp['Plaintext']))
+        return self._fernet
+
+    def get(self, ciphertext_blob):
+        from cryptography.fernet import InvalidToken
+        token = self._data['entries'].get(self.blob_key(ciphertext_blob))
+        if token is None:
+            return None
+        try:
+            return self._get_fernet().decrypt(token.encode('utf-8'),
+                                              ttl=self.ttl)
+        except InvalidToken:
+            # Expired, or written with a different data key.
+            return None
+
+    def set(self, ciphertext_blob, plaintext):
+        token = self._get_fernet().encrypt(plaintext)
+        self._data['entries'][self.blob_key(ciphertext_blob)] = (
+            token.decode('utf-8'))
+        self._dirty = True
+
+    def save(self):
+        from cryptography.fernet import InvalidToken
+        if not self._dirty:
+            return
+        fernet = self._get_fernet()
+        entries = self._data['entries']
+        for key, token in list(entries.items()):
+            try:
+                fernet.decrypt(token.encode('utf-8'), ttl=self.ttl)
+            except InvalidToken:
+                del entries[key]
+        cache.write_json(self.path, self._data)
+        self._dirty = False
@@ -3,31 +3,59 @@ import logging
 import os
 import sys
 
-from . import config
-from . import deploy
-from . import utils
+# config, deploy and utils are imported by the subcommands that use them, so
+# that `--help` or `yoke encrypt` don't load docker, jinja2, jsonref, ...
+from . import trace
 
 LOG = logging.getLogger(__name__)
 
 
 def build(args):
-    deploy.build(args.config)
+    from . import deploy
+    deploy.build(args.config, size_report=args.size_report)
 
 
 def build_dependencies(args):
+    from . import deploy
     deploy.build_dependencies(args.config)
 
 
 def decrypt(args):
+    from . import utils
     utils.decrypt(args.config, output=True)
 
 
 def deploy_app(args):
-    deploy.deploy_app(args.config)
+    from . import deploy
+    deploy.deploy_app(args.config, force=args.force, workers=args.workers,
+                      timings=args.timings,
+                      swagger_files=args.swagger_files)
+
+
+def profile_imports(args):
+    from . import deploy
+    deploy.profile_imports(args.config, python=args.python, runs=args.runs,
+                           min_ms=args.min_ms)
 
 
 def encrypt(args):
-    utils.encrypt(args.config, output=True)
+    from . import utils
+    configs = [args.config]
+    for stage in args.stages or []:
+        if stage != args.stage:
+            configs.append(load_config(args, stage, {}, skip_decrypt=True))
+    utils.encrypt_stages(configs, output=not args.in_place,
+                         in_place=args.in_place)
+
+
+def comma_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def load_config(args, stage, env_dict, skip_decrypt=False):
+    from . import config
+    _cfg = config.YokeConfig(args, args.project_dir, stage, env_dict)
+    return _cfg.get_config(skip_decrypt=skip_decrypt)
 
 
 def main(arv=None):
@@ -40,6 +68,9 @@ def main(arv=None):
     parser.add_argument('--debug', dest='loglevel', help='Debug logging',
                         action='store_const', const=logging.DEBUG)
     parser.set_defaults(loglevel=logging.WARNING)
+    parser.add_argument('--trace', dest='trace', metavar='FILE',
+                        help=('Write a Chrome trace of every phase to FILE '
+                              'and print a summary at the end'))
 
     deploy_parser = subparsers.add_parser(
         'deploy',
@@ -51,6 +82,21 @@ def main(arv=None):
                                      'config - can be used multiple times'),
                                default=[], action='append',
                                metavar='KEYNAME=VALUE')
+    deploy_parser.add_argument('--force', dest='force', action='store_true',
+                               help=('Upload and deploy even if the live '
+                                     'Lambda and API already match'))
+    deploy_parser.add_argument('--workers', dest='workers', type=int,
+                               help=('Number of deployment steps to run in '
+                                     'parallel (default: 4, 1 deploys '
+                                     'sequentially)'))
+    deploy_parser.add_argument('--timings', dest='timings',
+                               action='store_true',
+                               help=('Print the deployment steps with their '
+                                     'dependencies and timings'))
+    deploy_parser.add_argument('--no-swagger-files', dest='swagger_files',
+                               action='store_false',
+                               help=('Don\'t write swagger.yml and '
+                                     'swagger.json to the project directory'))
     deploy_parser.add_argument('project_dir', default=os.getcwd(), nargs='?',
                                help='Project directory containing yoke.yml')
     deploy_parser.set_defaults(func=deploy_app)
@@ -65,6 +111,10 @@ def main(arv=None):
                                     'config - can be used multiple times'),
                               default=[], action='append',
                               metavar='KEYNAME=VALUE')
+    build_parser.add_argument('--size-report', dest='size_report',
+                              metavar='FILE',
+                              help=('Write the package size breakdown to '
+                                    'FILE as JSON'))
     build_parser.add_argument('project_dir', default=os.getcwd(), nargs='?',
                               help='Project directory containing yoke.yml')
     build_parser.set_defaults(func=build)
@@ -84,6 +134,34 @@ def main(arv=None):
         help='Project directory containing yoke.yml')
     build_dependencies_parser.set_defaults(func=build_dependencies)
 
+    profile_imports_parser = subparsers.add_parser(
+        'profile-imports',
+        help='Measure the import time of the handler in the built package.')
+    profile_imports_parser.add_argument(
+        '--stage', dest='stage', help='Stage to build',
+        default=os.getenv('YOKE_STAGE'))
+    profile_imports_parser.add_argument(
+        '--environment', '-e', dest='environment',
+        help='Extra config values for lambda config - can be used multiple '
+             'times',
+        default=[], action='append',
+        metavar='KEYNAME=VALUE')
+    profile_imports_parser.add_argument(
+        '--python', dest='python', metavar='PATH',
+        help='Python interpreter to import with (default: the one running '
+             'yoke)')
+    profile_imports_parser.add_argument(
+        '--runs', dest='runs', type=int, default=3,
+        help='Import this many times and report the fastest (default: 3)')
+    profile_imports_parser.add_argument(
+        '--min-ms', dest='min_ms', type=float, default=1.0,
+        help='Leave out modules that take less than this many milliseconds '
+             '(default: 1)')
+    profile_imports_parser.add_argument(
+        'project_dir', default=os.getcwd(), nargs='?',
+        help='Project directory containing yoke.yml')
+    profile_imports_parser.set_defaults(func=profile_imports)
+
     decrypt_parser = subparsers.add_parser(
         'decrypt',
         help='Decrypt secrets stored in yoke.yml.')
@@ -100,6 +178,14 @@ def main(arv=None):
     encrypt_parser.add_argument('--stage', dest='stage',
                                 help='Stage to encrypt',
                                 default=os.getenv('YOKE_STAGE'))
+    encrypt_parser.add_argument('--stages', dest='stages', type=comma_list,
+                                metavar='STAGE[,STAGE...]',
+                                help='Encrypt several stages in one go, '
+                                     'e.g. dev,staging,prod')
+    encrypt_parser.add_argument('--in-place', dest='in_place',
+                                action='store_true',
+                                help='Write the encrypted secrets back to '
+                                     'yoke.yml instead of printing them')
     encrypt_parser.add_argument('project_dir', default=os.getcwd(), nargs='?',
                                 help='Project directory containing yoke.yml')
     encrypt_parser.set_defaults(func=encrypt)
@@ -113,25 +199,39 @@ def main(arv=None):
     else:
         logging.basicConfig(level=args.loglevel, stream=sys.stdout)
 
+    if args.trace:
+        trace.enable()
     try:
-        args.project_dir = os.path.abspath(args.project_dir)
-        if hasattr(args, 'environment'):
-            env_dict = utils.format_env(args.environment)
-        else:
-            env_dict = {}
-        # Some commands (currently: build-dependencies) don't require a stage
-        # to work, so let's just fake one here to make sure things continue to
-        # work.
-        if not hasattr(args, 'stage'):
-            args.stage = 'nostage'
-        _cfg = config.YokeConfig(args, args.project_dir, args.stage, env_dict)
-        skip_decrypt = args.func.__name__ in (
-            'build_dependencies',
-            'encrypt',
-            'decrypt',
-        )
-        args.config = _cfg.get_config(skip_decrypt=skip_decrypt)
-        args.func(args)
+        with trace.span('yoke.{}'.format(args.func.__name__)):
+            run(args)
     except Exception:
         LOG.exception('ERROR!')
         sys.exit(1)
+    finally:
+        if args.trace:
+            trace.get_tracer().write(args.trace)
+            print(trace.get_tracer().summary())
+
+
+def run(args):
+    from . import utils
+    args.project_dir = os.path.abspath(args.project_dir)
+    if hasattr(args, 'environment'):
+        env_dict = utils.format_env(args.environment)
+    else:
+        env_dict = {}
+    # Some commands (currently: build-dependencies) don't require a stage
+    # to work, so let's just fake one here to make sure things continue to
+    # work.
+    if not hasattr(args, 'stage'):
+        args.stage = 'nostage'
+    if getattr(args, 'stages', None) and not args.stage:
+        args.stage = args.stages[0]
+    skip_decrypt = args.func.__name__ in (
+        'build_dependencies',
+        'encrypt',
+        'decrypt',
+    )
+    args.config = load_config(args, args.stage, env_dict,
+                              skip_decrypt=skip_decrypt)
+    args.func(args)
@@ -0,0 +1,318 @@
+"""Where the bytes of a Lambda package come from.
+
+Files installed into an extra directory (usually `lib/`) are attributed to
+their distribution through its `RECORD` (or `installed-files.txt`), and
+distributions to the top-level requirements in `requirements.txt` that
+pulled them in.
+"""
+
+from collections import OrderedDict
+import csv
+import io
+import logging
+import os
+import posixpath
+import re
+import zipfile
+
+from . import trace
+
+LOG = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# Directories are reported down to this depth.
+DIRECTORY_DEPTH = 2
+# Rows printed per table, the JSON report has all of them.
+REPORT_ROWS = 15
+FUNCTION_CODE = '(function code)'
+UNATTRIBUTED = '(unattributed)'
+
+PYCACHE_FILE = re.compile(r'^(.*?)__pycache__/([^/.]+)\.[^/]+\.pyc$')
+REQUIREMENT_NAME = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
+
+
+def canonical_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def source_name(arcname):
+    """The `.py` file a bytecode file was compiled from, if it is one."""
+    match = PYCACHE_FILE.match(arcname)
+    if match:
+        return '{}{}.py'.format(*match.groups())
+    if arcname.endswith('.pyc'):
+        return arcname[:-1]
+    return arcname
+
+
+class Distribution(object):
+
+    def __init__(self, name, version, requires, files):
+        self.name = name
+        self.version = version
+        self.requires = requires
+        self.files = files
+        self.required_by = []
+
+
+def read_metadata(path):
+    name = version = None
+    requires = []
+    with io.open(path, encoding='utf-8', errors='replace') as fh:
+        for line in fh:
+            if not line.strip():
+                # Headers end at the first blank line.
+                break
+            key, _, value = line.partition(':')
+            value = value.strip()
+            if key == 'Name':
+                name = value
+            elif key == 'Version':
+                version = value
+            elif key == 'Requires-Dist':
+                requirement, _, marker = value.partition(';')
+                # Extras aren't installed unless asked for explicitly, and
+                # then they show up as a requirement of their own.
+                if 'extra' in marker:
+                    continue
+                match = REQUIREMENT_NAME.match(requirement)
+                if match:
+                    requires.append(canonical_name(match.group(1)))
+    return name, version, requires
+
+
+def read_egg_requires(path):
+    requires = []
+    if not os.path.isfile(path):
+        return requires
+    with io.open(path, encoding='utf-8', errors='replace') as fh:
+        for line in fh:
+            if line.startswith('['):
+                # Sections for extras and markers follow the plain ones.
+                break
+            match = REQUIREMENT_NAME.match(line)
+            if match:
+                requires.append(canonical_name(match.group(1)))
+    return requires
+
+
+def read_dist_info(site_dir, prefix, info_dir):
+    path = os.path.join(site_dir, info_dir)
+    if info_dir.endswith('.dist-info'):
+        metadata = os.path.join(path, 'METADATA')
+        record = os.path.join(path, 'RECORD')
+        requires = None
+    else:
+        metadata = os.path.join(path, 'PKG-INFO')
+        record = os.path.join(path, 'installed-files.txt')
+        requires = read_egg_requires(os.path.join(path, 'requires.txt'))
+    if not os.path.isfile(metadata):
+        return None
+    name, version, dist_requires = read_metadata(metadata)
+    name = name or info_dir.split('-')[0]
+
+    files = set()
+    if os.path.isfile(record):
+        with io.open(record, encoding='utf-8', errors='replace') as fh:
+            for row in csv.reader(fh):
+                if not row:
+                    continue
+                if record.endswith('RECORD'):
+                    relpath = posixpath.normpath(row[0])
+                else:
+                    # installed-files.txt is relative to the egg-info
+                    # directory.
+                    relpath = posixpath.normpath(
+                        posixpath.join(info_dir, row[0]))
+                if relpath.startswith('..'):
+                    # Scripts and data installed outside of the directory.
+                    continue
+                files.add(posixpath.join(prefix, relpath))
+    return Distribution(name, version,
+                        requires if requires is not None else dist_requires,
+                        files)
+
+
+def find_distributions(extra_files):
+    """Distributions installed in the extra directories of a package, with
+    the archive names of their files."""
+    distributions = OrderedDict()
+    for extra in extra_files or []:
+        if not os.path.isdir(extra):
+            continue
+        # Same archive names as `packager.collect_entries`.
+        prefix = os.path.basename(extra)
+        for info_dir in sorted(os.listdir(extra)):
+            if not info_dir.endswith(('.dist-info', '.egg-info')):
+                continue
+            dist = read_dist_info(extra, prefix, info_dir)
+            if dist is not None:
+                distributions[canonical_name(dist.name)] = dist
+    return distributions
+
+
+def read_requirements(lambda_path):
+    path = os.path.join(lambda_path, 'requirements.txt')
+    requirements = []
+    if not os.path.isfile(path):
+        return requirements
+    with open(path, 'r') as fh:
+        for line in fh:
+            line = line.split('#', 1)[0]
+            if line.strip().startswith('-'):
+                continue
+            match = REQUIREMENT_NAME.match(line)
+            if match:
+                requirements.append(canonical_name(match.group(1)))
+    return requirements
+
+
+def resolve_required_by(distributions, requirements):
+    for requirement in requirements:
+        seen = set()
+        pending = [requirement]
+        while pending:
+            name = pending.pop()
+            if name in seen or name not in distributions:
+                continue
+            seen.add(name)
+            distributions[name].required_by.append(requirement)
+            pending.extend(distributions[name].requires)
+
+
+def attribute(arcname, owners, top_levels, lambda_path):
+    source = source_name(arcname)
+    for name in (arcname, source):
+        if name in owners:
+            return owners[name]
+    # Files written after the install (compiled bytecode, ...) belong to
+    # whoever owns their top-level package.
+    top_level = source.split('/')[0]
+    if top_levels.get(top_level):
+        return top_levels[top_level]
+    if os.path.exists(os.path.join(lambda_path, *source.split('/'))):
+        return FUNCTION_CODE
+    return UNATTRIBUTED
+
+
+def new_row(**fields):
+    row = OrderedDict(fields)
+    row.update([('files', 0), ('compressed', 0), ('uncompressed', 0)])
+    return row
+
+
+def add_member(row, info):
+    row['files'] += 1
+    row['compressed'] += info.compress_size
+    row['uncompressed'] += info.file_size
+
+
+def by_size(rows):
+    return sorted(rows, key=lambda row: (-row['compressed'],
+                                         -row['uncompressed']))
+
+
+@trace.traced('package.size_report')
+def package_report(zip_file, lambda_path, extra_files=None, name=None):
+    """Compressed and uncompressed bytes of a package, per distribution and
+    per directory, as a dict ready to be dumped as JSON."""
+    distributions = find_distributions(extra_files)
+    resolve_required_by(distributions, read_requirements(lambda_path))
+    owners = {}
+    top_levels = {}
+    for key, dist in distributions.items():
+        for arcname in dist.files:
+            owners[arcname] = key
+            top_level = arcname.split('/')[0]
+            # Namespace packages can be shared by several distributions.
+            if top_levels.setdefault(top_level, key) != key:
+                top_levels[top_level] = None
+
+    dist_rows = OrderedDict()
+    dir_rows = OrderedDict()
+    with zipfile.ZipFile(zip_file) as archive:
+        members = archive.infolist()
+    for info in members:
+        key = attribute(info.filename, owners, top_levels, lambda_path)
+        if key not in dist_rows:
+            dist = distributions.get(key)
+            if dist is None:
+                dist_rows[key] = new_row(name=key)
+            else:
+                dist_rows[key] = new_row(name=dist.name, version=dist.version,
+                                         requiredBy=sorted(dist.required_by))
+        add_member(dist_rows[key], info)
+        parts = info.filename.split('/')[:-1]
+        for depth in range(1, min(len(parts), DIRECTORY_DEPTH) + 1):
+            path = '/'.join(parts[:depth])
+            if path not in dir_rows:
+                dir_rows[path] = new_row(path=path)
+            add_member(dir_rows[path], info)
+
+    report = OrderedDict([
+        ('function', name),
+        ('package', zip_file),
+        ('files', len(members)),
+        ('compressed', os.path.getsize(zip_file)),
+        ('uncompressed', sum(info.file_size for info in members)),
+        ('distributions', by_size(dist_rows.values())),
+        ('directories', by_size(dir_rows.values())),
+    ])
+    trace.annotate(bytes=report['compressed'])
+    return report
+
+
+def format_bytes(size):
+    return '{:.2f}MB'.format(size / float(MB))
+
+
+def format_report(report):
+    line = '{:<40} {:>7} {:>11} {:>13}'
+    lines = ['Package {} ({}): {} files, {} compressed, {} '
+             'uncompressed'.format(
+                 report['package'], report['function'], report['files'],
+                 format_bytes(report['compressed']),
+                 format_bytes(report['uncompressed']))]
+    for title, key, rows in (
+            ('distribution', 'name', report['distributions']),
+            ('directory', 'path', report['directories'])):
+        lines.append('')
+        lines.append(line.format(title, 'files', 'compressed',
+                                 'uncompressed'))
+        for row in rows[:REPORT_ROWS]:
+            label = row[key]
+            if row.get('requiredBy') and row['requiredBy'] != [
+                    canonical_name(row[key])]:
+                label = '{} <- {}'.format(label, ', '.join(row['requiredBy']))
+            lines.append(line.format(
+                label, row['files'], format_bytes(row['compressed']),
+                format_bytes(row['uncompressed'])))
+        if len(rows) > REPORT_ROWS:
+            lines.append('... {} more'.format(len(rows) - REPORT_ROWS))
+    return '\n'.join(lines)
+
+
+def over_budget(report, budget):
+    """Descriptions of the `sizeBudget` limits (in MB) the package exceeds."""
+    exceeded = []
+
+    def check(label, size, limit):
+        if limit is not None and size > float(limit) * MB:
+            exceeded.append('{} is {}, over its budget of {}MB'.format(
+                label, format_bytes(size), limit))
+
+    check('Compressed package', report['compressed'],
+          budget.get('compressed'))
+    check('Uncompressed package', report['uncompressed'],
+          budget.get('uncompressed'))
+    dist_sizes = dict((canonical_name(row['name']), row['uncompressed'])
+                      for row in report['distributions'])
+    for name, limit in sorted((budget.get('distributions') or {}).items()):
+        check('Distribution {}'.format(name),
+              dist_sizes.get(canonical_name(name), 0), limit)
+    dir_sizes = dict((row['path'], row['uncompressed'])
+                     for row in report['directories'])
+    for path, limit in sorted((budget.get('directories') or {}).items()):
+        check('Directory {}'.format(path), dir_sizes.get(path.strip('/'), 0),
+              limit)
+    return exceeded
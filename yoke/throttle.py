@@ -0,0 +1,195 @@
+from collections import defaultdict
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ConnectionError, HTTPClientError
+
+from . import trace
+
+LOG = logging.getLogger(__name__)
+
+# Everything botocore's own retry handlers treat as throttling or transient,
+# see botocore/data/_retry.json and botocore/retries/standard.py.
+THROTTLING_ERROR_CODES = (
+    'BandwidthLimitExceeded',
+    'EC2ThrottledException',
+    'LimitExceededException',
+    'PriorRequestNotComplete',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'SlowDown',
+    'ThrottledException',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'TransactionInProgressException',
+)
+THROTTLING_STATUS_CODES = (429, 509)
+TRANSIENT_ERROR_CODES = (
+    'IDPCommunicationError',
+    'RequestTimeout',
+    'RequestTimeoutException',
+)
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+
+# Requests per second and burst size for each API family, per region. These
+# are shared by every client and thread in the process.
+FAMILY_LIMITS = {
+    'apigateway': (5, 10),
+    'kms': (50, 50),
+    'lambda': (10, 20),
+}
+DEFAULT_LIMIT = (20, 40)
+
+MAX_ATTEMPTS = 10
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# A throttled bucket slows down to this fraction of its rate at most, and
+# takes this many seconds to get back to full speed.
+MIN_RATE_FACTOR = 0.1
+RECOVERY_SECONDS = 10
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket allowing `rate` calls per second on average
+    with bursts of up to `capacity` calls.
+
+    `backoff()` halves the rate when the service pushes back, and it
+    recovers linearly over `RECOVERY_SECONDS` afterwards."""
+
+    def __init__(self, rate, capacity=None):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        elapsed = now - self._updated
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self.rate = min(self.max_rate, self.rate +
+                        self.max_rate * elapsed / RECOVERY_SECONDS)
+        self._updated = now
+
+    def consume(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def backoff(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.max_rate * MIN_RATE_FACTOR, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+
+class Scheduler(object):
+    """Paces and retries the calls of every registered boto3 client.
+
+    Calls are paced by a token bucket per API family and region. Calls that
+    are throttled, or fail with a transient error, are retried on their own
+    with jittered exponential backoff, honouring any Retry-After the service
+    sends. This replaces botocore's own retry handler for the client.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = dict(FAMILY_LIMITS)
+        self.limits.update(limits or {})
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.throttled_seconds = defaultdict(float)
+        self.throttled_calls = defaultdict(int)
+
+    def bucket(self, family, region):
+        with self._lock:
+            key = (family, region)
+            if key not in self._buckets:
+                rate, capacity = self.limits.get(family, DEFAULT_LIMIT)
+                self._buckets[key] = TokenBucket(rate, capacity)
+            return self._buckets[key]
+
+    def register(self, client, family):
+        bucket = self.bucket(family, client.meta.region_name)
+        model = client.meta.service_model
+        try:
+            event_name = model.service_id.hyphenize()
+        except AttributeError:
+            # Older botocore releases name events after the endpoint prefix.
+            event_name = model.endpoint_prefix
+        events = client.meta.events
+        events.unregister('needs-retry.{}'.format(event_name),
+                          unique_id='retry-config-{}'.format(event_name))
+        # Emitted once per attempt, including retries.
+        events.register('request-created.{}'.format(event_name),
+                        lambda **kwargs: bucket.consume(),
+                        unique_id='yoke-pace-{}'.format(event_name))
+        events.register('needs-retry.{}'.format(event_name),
+                        lambda **kwargs: self.needs_retry(family, bucket,
+                                                          **kwargs),
+                        unique_id='yoke-retry-{}'.format(event_name))
+
+    def needs_retry(self, family, bucket, response=None, attempts=None,
+                    caught_exception=None, operation=None, **kwargs):
+        """botocore `needs-retry` handler: returns how long to sleep before
+        the next attempt, or None to give up."""
+        retry_after = 0
+        throttled = False
+        if caught_exception is not None:
+            if not isinstance(caught_exception,
+                              (ConnectionError, HTTPClientError)):
+                return None
+            code = type(caught_exception).__name__
+        else:
+            http_response, parsed = response
+            status = http_response.status_code
+            code = parsed.get('Error', {}).get('Code') or 'HTTP {}'.format(
+                status)
+            throttled = (code in THROTTLING_ERROR_CODES or
+                         status in THROTTLING_STATUS_CODES)
+            if (not throttled and code not in TRANSIENT_ERROR_CODES and
+                    status not in TRANSIENT_STATUS_CODES):
+                return None
+            headers = parsed.get('ResponseMetadata', {}).get(
+                'HTTPHeaders', {})
+            try:
+                retry_after = float(headers.get('retry-after') or 0)
+            except ValueError:
+                pass
+        if attempts >= MAX_ATTEMPTS:
+            LOG.warning("Giving up on %s after %s attempts (%s).",
+                        operation.name, attempts, code)
+            return None
+
+        # "Full jitter" backoff, spreading out concurrent retries.
+        delay = max(retry_after, random.uniform(
+            0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempts)))
+        if throttled:
+            bucket.backoff()
+            with self._lock:
+                self.throttled_seconds[family] += delay
+                self.throttled_calls[family] += 1
+            trace.annotate(throttled_seconds=delay)
+        trace.annotate(retries=1)
+        LOG.warning("%s for %s - retrying in %.1fs ...", code,
+                    operation.name, delay)
+        return delay
+
+    def report(self):
+        for family in sorted(self.throttled_calls):
+            LOG.warning("Throttled %s times by %s, waited %.1fs.",
+                        self.throttled_calls[family], family,
+                        self.throttled_seconds[family])
+
+
+SCHEDULER = Scheduler()
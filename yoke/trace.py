@@ -0,0 +1,140 @@
+"""Spans covering the phases of a yoke command, written in the Chrome trace
+event format (load the file in chrome://tracing or https://ui.perfetto.dev).
+
+Tracing is off unless `enable()` is called, and spans are then close to
+free. Code adds details (byte counts, cache hits, ...) to the innermost span
+of the current thread with `annotate()`.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import threading
+import time
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_TRACER = None
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.pid = os.getpid()
+        self.events = []
+
+    def timestamp(self, when):
+        # Microseconds since the tracer was started.
+        return int((when - self.started) * 1e6)
+
+    def add(self, name, started, finished, args):
+        event = {
+            'name': name,
+            'cat': name.split('.')[0],
+            'ph': 'X',
+            'ts': self.timestamp(started),
+            'dur': self.timestamp(finished) - self.timestamp(started),
+            'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with _LOCK:
+            self.events.append(event)
+
+    def write(self, path):
+        with _LOCK:
+            events = list(self.events)
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for tid in set(event['tid'] for event in events):
+            events.append({'name': 'thread_name', 'ph': 'M',
+                           'pid': self.pid, 'tid': tid,
+                           'args': {'name': names.get(tid, str(tid))}})
+        with open(path, 'w') as fh:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fh)
+
+    def summary(self):
+        totals = OrderedDict()
+        with _LOCK:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        for event in events:
+            total = totals.setdefault(event['name'], {
+                'count': 0, 'seconds': 0.0, 'bytes': 0, 'cache_hits': 0,
+                'retries': 0})
+            total['count'] += 1
+            total['seconds'] += event['dur'] / 1e6
+            for key in ('bytes', 'cache_hits', 'retries'):
+                total[key] += event['args'].get(key, 0)
+        line = '{:<32} {:>6} {:>10} {:>12} {:>10} {:>8}'
+        lines = [line.format('span', 'count', 'time', 'bytes', 'cache hits',
+                             'retries')]
+        for name, total in totals.items():
+            lines.append(line.format(
+                name, total['count'], '{:.2f}s'.format(total['seconds']),
+                total['bytes'], total['cache_hits'], total['retries']))
+        return '\n'.join(lines)
+
+
+def enable():
+    global _TRACER
+    _TRACER = Tracer()
+    return _TRACER
+
+
+def get_tracer():
+    return _TRACER
+
+
+def _stack():
+    if not hasattr(_LOCAL, 'stack'):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+@contextmanager
+def span(name, **args):
+    tracer = _TRACER
+    if tracer is None:
+        yield args
+        return
+    stack = _stack()
+    stack.append(args)
+    started = time.time()
+    try:
+        yield args
+    except Exception as exc:
+        args['error'] = str(exc)
+        raise
+    finally:
+        stack.pop()
+        tracer.add(name, started, time.time(), args)
+
+
+def traced(name):
+    """Decorator wrapping every call of a function in a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**args):
+    """Add details to the innermost span of the current thread. Numbers are
+    added up, everything else is replaced."""
+    if _TRACER is None:
+        return
+    stack = _stack()
+    if not stack:
+        return
+    current = stack[-1]
+    for key, value in args.items():
+        if (isinstance(value, (int, float)) and
+                not isinstance(value, bool) and key in current):
+            current[key] += value
+        else:
+            current[key] = value
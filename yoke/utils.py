@@ -1,14 +1,47 @@
 import base64
 import json
 import logging
+import os
 
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 import ruamel.yaml as yaml
+from ruamel.yaml.constructor import SafeConstructor
+from ruamel.yaml.resolver import VersionedResolver
 from six import string_types
 
+from . import aws
+from . import trace
+from .secret_cache import SecretCache
+
 LOG = logging.getLogger(__name__)
 
 ENCRYPTED_PREFIX = 'encrypted::'
+KMS_MAX_WORKERS = 10
+
+try:
+    from ruamel.yaml.cyaml import CParser, CSafeDumper
+except ImportError:  # ruamel.yaml installed without libyaml
+    CParser = CSafeDumper = None
+
+if CParser is not None:
+    class FastSafeLoader(CParser, SafeConstructor, VersionedResolver):
+        """`yaml.SafeLoader` with libyaml's parser. ruamel.yaml's own
+        `CSafeLoader` resolves scalars with YAML 1.1 rules, this one keeps
+        the same (1.2) rules as `yaml.safe_load`, except that it can't see
+        `%YAML` directives."""
+
+        def __init__(self, stream, version=None, preserve_quotes=None):
+            CParser.__init__(self, stream)
+            self._parser = self._composer = self
+            try:
+                SafeConstructor.__init__(self, loader=self)
+                VersionedResolver.__init__(self, version, loader=self)
+            except TypeError:
+                # ruamel.yaml < 0.15
+                SafeConstructor.__init__(self)
+                VersionedResolver.__init__(self, version)
+else:
+    FastSafeLoader = None
 
 
 def check_encryption_required_fields(stage):
@@ -22,19 +55,21 @@ def is_value_already_encrypted(value):
     return value.startswith(ENCRYPTED_PREFIX)
 
 
+@trace.traced('kms.decrypt')
 def decrypt(config, output=False):
     stage = config['stage']
     check_encryption_required_fields(config['stages'][stage])
     region = config['stages'][stage]['keyRegion']
-    kms = boto3.client('kms', region_name=region)
+    kms = aws.get_client('kms', region)
+    secret_cache = SecretCache.for_stage(config, kms)
 
     enc_config = get_secret_config(config, stage)
     if isinstance(enc_config, string_types):
         # This is the old-style secretConfig, when everything was encrypted
         # into a single string.
         stage_cfg = base64.b64decode(enc_config)
-        resp = kms.decrypt(CiphertextBlob=stage_cfg)
-        plain = json.loads(resp['Plaintext'])
+        plaintext = decrypt_blobs(kms, {'': stage_cfg}, secret_cache)['']
+        plain = json.loads(plaintext)
         if output:
             print('Decrypted config for stage {}:\n\n{}'.format(
                 stage,
@@ -42,16 +77,14 @@ def decrypt(config, output=False):
         return plain
     elif isinstance(enc_config, dict):
         # This is the new way, where all config items are encrypted separately.
-        plain = {}
+        blobs = {}
         for key, value in enc_config.items():
             if is_value_already_encrypted(value):
-                ciphertext_blob = base64.b64decode(
-                    value[len(ENCRYPTED_PREFIX):])
-                resp = kms.decrypt(CiphertextBlob=ciphertext_blob)
-                plain[key] = resp['Plaintext']
+                blobs[key] = base64.b64decode(value[len(ENCRYPTED_PREFIX):])
             else:
                 raise Exception('Found unencrypted item in secretConfig: '
                                 '{}'.format(key))
+        plain = decrypt_blobs(kms, blobs, secret_cache)
         if output:
             print('Decrypted config for stage {}:\n\n{}'.format(
                 stage,
@@ -60,28 +93,154 @@ def decrypt(config, output=False):
 
 
 def encrypt(config, output=False):
-    stage = config['stages'][config['stage']]
-    check_encryption_required_fields(stage)
-    secret_config = get_secret_config(config, config['stage'])
-    if isinstance(secret_config, string_types):
-        raise Exception('Secret config for stage {} is already '
-                        'encrypted.'.format(config['stage']))
+    return encrypt_stages([config], output=output)
+
+
+@trace.traced('kms.encrypt')
+def encrypt_stages(configs, output=False, in_place=False):
+    yoke_path = os.path.join(configs[0]['project_dir'], 'yoke.yml')
+    with open(yoke_path, 'r') as fh:
+        document = round_trip_yaml().load(fh)
+    # Stages and their secrets in yoke.yml order. Snapshots and plain dicts
+    # don't necessarily keep it.
+    stage_keys = list(document['stages'])
+    configs = sorted(configs,
+                     key=lambda config: stage_keys.index(config['stage_key']))
+    secret_docs = [find_secret_config(document, config['stage_key'],
+                                      yoke_path)
+                   for config in configs]
+
+    # Collect everything that needs encrypting first, so that all stages can
+    # be encrypted concurrently.
+    jobs = []
+    for config in configs:
+        stage = config['stages'][config['stage']]
+        check_encryption_required_fields(stage)
+        secret_config = get_secret_config(config, config['stage'])
+        if isinstance(secret_config, string_types):
+            raise Exception('Secret config for stage {} is already '
+                            'encrypted.'.format(config['stage']))
+        for key, value in secret_config.items():
+            if not is_value_already_encrypted(value):
+                jobs.append((config['stage'], key, stage['keyRegion'],
+                             stage['keyName'], value))
+
+    encrypted = {}
+    if jobs:
+        LOG.warning('Encrypting %d secrets ...', len(jobs))
+        workers = min(KMS_MAX_WORKERS, len(jobs))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (stage, key, executor.submit(
+                    kms_encrypt, aws.get_client('kms', region), key_name,
+                    value))
+                for stage, key, region, key_name, value in jobs]
+            for stage, key, future in futures:
+                encrypted[(stage, key)] = future.result()
+
     if output:
-        print('Encrypted config for stage {}:\nsecretConfig:'.format(
-            config['stage']))
-    for key, value in secret_config.items():
-        if is_value_already_encrypted(value):
-            if output:
-                print('  {}: "{}"'.format(key, value))
-            continue
-        kms = boto3.client('kms', region_name=stage['keyRegion'])
-        key_name = 'alias/{}'.format(stage['keyName'])
-        resp = kms.encrypt(KeyId=key_name,
-                           Plaintext=value.encode('utf-8'))
-        if output:
-            encrypted_blob = base64.b64encode(
-                resp['CiphertextBlob']).decode('utf-8')
-            print('  {}: "{}{}"'.format(key, ENCRYPTED_PREFIX, encrypted_blob))
+        for config, secret_doc in zip(configs, secret_docs):
+            secret_config = get_secret_config(config, config['stage'])
+            print('Encrypted config for stage {}:\nsecretConfig:'.format(
+                config['stage']))
+            for key in secret_doc:
+                print('  {}: "{}"'.format(
+                    key, encrypted.get((config['stage'], key),
+                                       secret_config[key])))
+
+    if in_place:
+        write_encrypted_secrets(yoke_path, configs, secret_docs, encrypted)
+    return encrypted
+
+
+def load_yaml(stream):
+    """`yaml.safe_load`, using libyaml when it is available."""
+    if FastSafeLoader is None:
+        return yaml.safe_load(stream)
+    return yaml.load(stream, Loader=FastSafeLoader)
+
+
+def dump_yaml(data, stream=None):
+    """Dump plain data in block style, using libyaml when it is available.
+    Keys are sorted; use `round_trip_yaml` where comments and key order
+    matter."""
+    if CSafeDumper is None:
+        return yaml.safe_dump(data, stream, default_flow_style=False)
+    return yaml.dump(data, stream, Dumper=CSafeDumper,
+                     default_flow_style=False)
+
+
+def round_trip_yaml():
+    # The `YAML` API appeared in ruamel.yaml 0.15 and is the only one that
+    # keeps comments in newer releases.
+    if hasattr(yaml, 'YAML'):
+        round_trip = yaml.YAML()
+        round_trip.preserve_quotes = True
+        return round_trip
+
+    class RoundTrip(object):
+        load = staticmethod(yaml.round_trip_load)
+        dump = staticmethod(yaml.round_trip_dump)
+    return RoundTrip()
+
+
+def find_secret_config(document, stage_key, yoke_path):
+    stage_doc = document['stages'][stage_key]
+    for field in ('secret_config', 'secretConfig'):
+        if field in stage_doc:
+            return stage_doc[field]
+    raise Exception('Could not find the secretConfig for stage {} in '
+                    '{}.'.format(stage_key, yoke_path))
+
+
+def scalar_end(line, start):
+    """Where the scalar starting at `start` in `line` ends."""
+    quote = line[start]
+    if quote == "'":
+        end = start + 1
+        # Single quotes are escaped by doubling them.
+        while True:
+            end = line.index("'", end)
+            if line[end + 1:end + 2] != "'":
+                return end + 1
+            end += 2
+    if quote == '"':
+        end = start + 1
+        while True:
+            end = line.index('"', end)
+            if line[end - 1] != '\\':
+                return end + 1
+            end += 1
+    comment = line.find(' #', start)
+    end = len(line.rstrip('\r\n')) if comment < 0 else comment
+    return len(line[:end].rstrip())
+
+
+def write_encrypted_secrets(yoke_path, configs, secret_docs, encrypted):
+    """Replace the encrypted values in yoke.yml, and nothing else: quotes,
+    comments and spacing stay as they are."""
+    with open(yoke_path, 'r') as fh:
+        lines = fh.readlines()
+    for config, secret_doc in zip(configs, secret_docs):
+        for key in secret_doc:
+            value = encrypted.get((config['stage'], key))
+            if value is None:
+                continue
+            lineno, start = secret_doc.lc.value(key)
+            line = lines[lineno]
+            try:
+                end = scalar_end(line, start)
+            except ValueError:
+                raise Exception(
+                    'Secret {} of stage {} spans several lines in {}, it '
+                    "can't be encrypted in place.".format(
+                        key, config['stage_key'], yoke_path))
+            quote = line[start] if line[start] in '\'"' else ''
+            lines[lineno] = '{}{}{}{}{}'.format(line[:start], quote, value,
+                                                quote, line[end:])
+    with open(yoke_path, 'w') as fh:
+        fh.writelines(lines)
+    LOG.warning('Wrote %d encrypted secrets to %s', len(encrypted), yoke_path)
 
 
 def format_env(env_list):
@@ -95,6 +254,12 @@ def format_env(env_list):
     return env_dict
 
 
+def get_functions(config):
+    # The `Lambda` section, followed by any additional `functions`.
+    functions = [config['Lambda']] if config.get('Lambda') else []
+    return functions + list(config.get('functions') or [])
+
+
 def get_secret_config(config, stage):
     old_style = config['stages'][stage].get('secret_config')
     if old_style:
@@ -108,8 +273,43 @@ def get_secret_config(config, stage):
     return old_style if old_style else new_style
 
 
-def retry_if_api_limit(exception):
-    if 'TooManyRequestsException' in str(exception):
-        LOG.warning('Hit API Gateway rate limit - retrying ...')
-        return True
-    return False
+def decrypt_blobs(kms, blobs, secret_cache=None):
+    plain = {}
+    pending = {}
+    for key, ciphertext_blob in blobs.items():
+        cached = secret_cache.get(ciphertext_blob) if secret_cache else None
+        if cached is not None:
+            plain[key] = cached
+        else:
+            pending[key] = ciphertext_blob
+    if secret_cache:
+        LOG.warning('Found %d of %d secrets in the local cache.',
+                    len(plain), len(blobs))
+    trace.annotate(secrets=len(blobs), cache_hits=len(plain))
+
+    if pending:
+        LOG.warning('Decrypting %d secrets ...', len(pending))
+        workers = min(KMS_MAX_WORKERS, len(pending))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (key, executor.submit(kms_decrypt, kms, ciphertext_blob))
+                for key, ciphertext_blob in pending.items())
+            for key, future in futures.items():
+                plain[key] = future.result()
+
+    if secret_cache and pending:
+        for key, ciphertext_blob in pending.items():
+            secret_cache.set(ciphertext_blob, plain[key])
+        secret_cache.save()
+    return plain
+
+
+def kms_encrypt(kms, key_name, value):
+    resp = kms.encrypt(KeyId='alias/{}'.format(key_name),
+                       Plaintext=value.encode('utf-8'))
+    return ENCRYPTED_PREFIX + base64.b64encode(
+        resp['CiphertextBlob']).decode('utf-8')
+
+
+def kms_decrypt(kms, ciphertext_blob):
+    return kms.decrypt(CiphertextBlob=ciphertext_blob)['Plaintext']